@@ -0,0 +1,120 @@
+import argparse
+import os
+import random
+import time
+from collections import defaultdict
+
+import numpy as np
+
+from sifar_pytorch.video_dataset import VideoDataSetOnline
+from sifar_pytorch.video_readers import available_readers
+
+try:
+    import av
+    _HAS_PYAV = True
+except ImportError:
+    _HAS_PYAV = False
+
+
+def _read_bytes():
+    # bytes read by this process (linux), including the page cache
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _video_format(video_path):
+    ext = os.path.splitext(video_path)[1].lstrip('.').lower()
+    if not _HAS_PYAV:
+        return ext
+    try:
+        with av.open(video_path) as container:
+            return "{}/{}".format(ext, container.streams.video[0].codec_context.name)
+    except Exception:
+        return "{}/unknown".format(ext)
+
+
+def _summary(latencies, num_bytes):
+    latencies = np.asarray(latencies)
+    return "{:4d} clips {:8.2f} clips/s  p50 {:7.1f} ms  p99 {:7.1f} ms  {}".format(
+        len(latencies), len(latencies) / latencies.sum(), np.percentile(latencies, 50) * 1000,
+        np.percentile(latencies, 99) * 1000,
+        "{:.1f} MB/clip".format(num_bytes / len(latencies) / 1024 ** 2) if num_bytes is not None else "")
+
+
+def benchmark_readers(data_dir, list_file, readers, num_videos=200, num_groups=8, frames_per_group=1,
+                      num_clips=1, dense_sampling=False, short_side=None, seperator=' ', seed=0):
+    datasets = {name: VideoDataSetOnline(data_dir, list_file, num_groups, frames_per_group, num_clips=num_clips,
+                                         dense_sampling=dense_sampling, seperator=seperator,
+                                         decode_short_side=short_side, clip_format='array', reader=name)
+                for name in readers}
+    video_list = next(iter(datasets.values())).video_list
+    rng = random.Random(seed)
+    samples = rng.sample(range(len(video_list)), min(num_videos, len(video_list)))
+    formats = {i: _video_format(os.path.join(data_dir, video_list.path(i))) for i in samples}
+
+    for name, dataset in datasets.items():
+        # the same clips for every reader
+        np.random.seed(seed)
+        latencies = defaultdict(list)
+        num_bytes = defaultdict(int)
+        num_failed = 0
+        for i in samples:
+            record = video_list[i]
+            indices = dataset._sample_indices(record)
+            bytes_before = _read_bytes()
+            start = time.perf_counter()
+            try:
+                dataset.decode_frames(record, indices)
+            except Exception as e:
+                num_failed += 1
+                print("{} failed on {}: {}".format(name, record.path, e), flush=True)
+                continue
+            latencies[formats[i]].append(time.perf_counter() - start)
+            if bytes_before is not None:
+                num_bytes[formats[i]] += _read_bytes() - bytes_before
+
+        all_latencies = [x for v in latencies.values() for x in v]
+        if len(all_latencies) == 0:
+            print("{:12s} no clip is read".format(name))
+            continue
+        print("{:12s} {} (failed: {})".format(
+            name, _summary(all_latencies, sum(num_bytes.values()) if bytes_before is not None else None), num_failed))
+        for video_format in sorted(latencies):
+            print("  {:10s} {}".format(video_format, _summary(
+                latencies[video_format], num_bytes[video_format] if bytes_before is not None else None)))
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Video reader benchmark', add_help=False)
+    parser.add_argument('--data_dir', type=str, default='', help='path to the videos, prefixed to the list entries')
+    parser.add_argument('--list_file', type=str, help='list file, each line with path, start_frame, end_frame, label_id')
+    parser.add_argument('--readers', type=str, nargs='+', default=None,
+                        help='readers to compare, defaults to all the installed ones')
+    parser.add_argument('--num_videos', type=int, default=200, help='number of videos sampled from the list file')
+    parser.add_argument('--duration', type=int, default=8, help='number of frames per clip')
+    parser.add_argument('--frames_per_group', type=int, default=1)
+    parser.add_argument('--num_clips', type=int, default=1)
+    parser.add_argument('--dense_sampling', action='store_true')
+    parser.add_argument('--short_side', type=int, default=None, help='resize the frames to this shorter side')
+    parser.add_argument('--seperator', type=str, default=' ')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser
+
+
+def main(args):
+    readers = args.readers if args.readers is not None else available_readers()
+    print("Readers: {}".format(', '.join(readers)))
+    benchmark_readers(args.data_dir, args.list_file, readers, args.num_videos, args.duration, args.frames_per_group,
+                      args.num_clips, args.dense_sampling, args.short_side, args.seperator, args.seed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('Video reader benchmark', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,122 @@
+import argparse
+import io
+import os
+import time
+from multiprocessing import Pool
+
+import av
+import lmdb
+
+from sifar_pytorch.video_dataset import write_lmdb_video, write_lmdb_header, lmdb_frame_key
+
+
+def _parse_list(list_file, seperator=' '):
+    videos = []
+    for x in open(list_file):
+        elements = x.strip().split(seperator)
+        if len(elements) < 4:
+            continue
+        labels = [float(l) for l in elements[3:]]
+        label = int(labels[0]) if len(labels) == 1 else labels
+        videos.append((elements[0], int(elements[1]), int(elements[2]), label))
+    return videos
+
+
+def _read_video(args):
+    path, start_frame, end_frame, label, data_dir, image_tmpl, jpeg_quality, modality = args
+    key = os.path.basename(path)
+    full_path = os.path.join(data_dir, path)
+    try:
+        frames = []
+        if os.path.isdir(full_path):
+            # frame folder, store the encoded images as they are, x, y of a flow frame are consecutive
+            for i in range(start_frame, end_frame + 1):
+                names = ["x_" + image_tmpl.format(i), "y_" + image_tmpl.format(i)] if modality == 'flow' \
+                    else [image_tmpl.format(i)]
+                for name in names:
+                    with open(os.path.join(full_path, name), 'rb') as f:
+                        frames.append(f.read())
+        elif modality == 'flow':
+            raise ValueError("flow is only read from frame folders")
+        else:
+            container = av.open(full_path)
+            container.streams.video[0].thread_type = "AUTO"
+            decoded = {}
+            for frame in container.decode({'video': 0}):
+                decoded[frame.pts] = frame
+            container.close()
+            for pts in sorted(decoded):
+                buf = io.BytesIO()
+                decoded[pts].to_image().save(buf, format='JPEG', quality=jpeg_quality)
+                frames.append(buf.getvalue())
+    except Exception as e:
+        print("Failed to read {}: {}".format(full_path, e), flush=True)
+        return key, None, label
+    return key, frames, label
+
+
+def build_lmdb(data_dir, list_file, output, image_tmpl='{:05d}.jpg', seperator=' ', num_workers=8,
+               map_size=1024, commit_every=500, jpeg_quality=95, modality='rgb'):
+    videos = _parse_list(list_file, seperator)
+    db = lmdb.open(output, map_size=int(map_size * 1024 ** 3), subdir=os.path.isdir(output), meminit=False)
+
+    # resume: a video is complete once its meta is committed, it is written last in the same transaction
+    with db.begin(write=False) as txn:
+        done = set([os.path.basename(v[0]) for v in videos
+                    if txn.get(lmdb_frame_key(os.path.basename(v[0]), '__meta__')) is not None])
+    jobs = [(path, start_frame, end_frame, label, data_dir, image_tmpl, jpeg_quality, modality)
+            for path, start_frame, end_frame, label in videos if os.path.basename(path) not in done]
+    print("{} videos in the list, {} already in {}".format(len(videos), len(done), output), flush=True)
+
+    start = time.time()
+    txn = db.begin(write=True)
+    num_failed = 0
+    with Pool(num_workers) as pool:
+        for i, (key, frames, label) in enumerate(pool.imap_unordered(_read_video, jobs, chunksize=4)):
+            if frames is None or len(frames) == 0:
+                num_failed += 1
+            else:
+                # flow has two images per frame, see the layout of `LMDB_FORMAT`
+                write_lmdb_video(txn, key, frames, label,
+                                 num_frames=len(frames) // 2 if modality == 'flow' else len(frames))
+                done.add(key)
+            if (i + 1) % commit_every == 0:
+                txn.commit()
+                txn = db.begin(write=True)
+                print("Written {}/{} videos ({:.1f}s)".format(i + 1, len(jobs), time.time() - start), flush=True)
+
+    keys = list(dict.fromkeys([os.path.basename(v[0]) for v in videos if os.path.basename(v[0]) in done]))
+    write_lmdb_header(txn, keys)
+    txn.commit()
+    db.close()
+    print("Saved {} videos (failed: {}) to {}".format(len(keys), num_failed, output))
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('LMDB script', add_help=False)
+    parser.add_argument('--data_dir', type=str, default='',
+                        help='path to the frame folders or videos, prefixed to the list entries')
+    parser.add_argument('--list_file', type=str, help='list file, each line with path, start_frame, end_frame, label_id')
+    parser.add_argument('--output', type=str, default=None,
+                        help='database, defaults to <list_file without extension>.lmdb')
+    parser.add_argument('--image_tmpl', type=str, default='{:05d}.jpg', help='template of the frames in a folder')
+    parser.add_argument('--modality', type=str, default='rgb', choices=['rgb', 'flow'],
+                        help='[flow] reads the x_/y_ images of frame folders')
+    parser.add_argument('--seperator', type=str, default=' ')
+    parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--map_size', type=float, default=1024, help='maximum size of the database in GB')
+    parser.add_argument('--commit_every', type=int, default=500, help='number of videos per write transaction')
+    parser.add_argument('--jpeg_quality', type=int, default=95, help='quality of the frames encoded from videos')
+    return parser
+
+
+def main(args):
+    output = args.output if args.output is not None else os.path.splitext(args.list_file)[0] + '.lmdb'
+    build_lmdb(args.data_dir, args.list_file, output, args.image_tmpl, args.seperator, args.num_workers,
+               args.map_size, args.commit_every, args.jpeg_quality, args.modality)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('LMDB script', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
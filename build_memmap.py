@@ -0,0 +1,81 @@
+import argparse
+import os
+import time
+from multiprocessing import Pool
+
+import av
+import numpy as np
+
+from sifar_pytorch.video_dataset import frame_to_ndarray, save_memmap_index, default_memmap_path
+
+
+def _decode(args):
+    path, video_path, short_side = args
+    try:
+        container = av.open(video_path)
+        container.streams.video[0].thread_type = "AUTO"
+        frames = {}
+        for frame in container.decode({'video': 0}):
+            frames[frame.pts] = frame_to_ndarray(frame, short_side)
+        container.close()
+        video = np.asarray([frames[pts] for pts in sorted(frames)], dtype=np.uint8)
+    except Exception as e:
+        print("Failed to decode {}: {}".format(video_path, e), flush=True)
+        return path, None
+    return path, video
+
+
+def build_memmap(data_dir, list_file, output, short_side=256, seperator=' ', num_workers=8):
+    paths = []
+    for x in open(list_file):
+        elements = x.strip().split(seperator)
+        if len(elements) > 0 and elements[0] != '':
+            paths.append(elements[0])
+    paths = list(dict.fromkeys(paths))
+
+    jobs = [(path, os.path.join(data_dir, path), short_side) for path in paths]
+    stored_paths, offsets, num_frames, heights, widths = [], [], [], [], []
+    offset = 0
+    start = time.time()
+    with Pool(num_workers) as pool, open(output, 'wb') as f:
+        # imap keeps the list order, the frames are appended to the store as they arrive
+        for i, (path, video) in enumerate(pool.imap(_decode, jobs, chunksize=1)):
+            if video is not None and len(video) > 0:
+                f.write(video.tobytes())
+                stored_paths.append(path)
+                offsets.append(offset)
+                num_frames.append(video.shape[0])
+                heights.append(video.shape[1])
+                widths.append(video.shape[2])
+                offset += video.size
+            if (i + 1) % 100 == 0:
+                print("Decoded {}/{} videos, {:.1f} GB ({:.1f}s)".format(
+                    i + 1, len(jobs), offset / 1024 ** 3, time.time() - start), flush=True)
+
+    save_memmap_index(output, stored_paths, offsets, num_frames, heights, widths)
+    print("Saved {} frames of {} videos (failed: {}) to {}".format(
+        sum(num_frames), len(stored_paths), len(paths) - len(stored_paths), output))
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Frame store script', add_help=False)
+    parser.add_argument('--data_dir', type=str, default='', help='path to the videos, prefixed to the list entries')
+    parser.add_argument('--list_file', type=str, help='list file, each line with path, start_frame, end_frame, label_id')
+    parser.add_argument('--output', type=str, default=None,
+                        help='frame store, defaults to <list_file without extension>.frames (index in <output>.npz)')
+    parser.add_argument('--short_side', type=int, default=256,
+                        help='shorter side of the stored frames, usually the scale size of the augmentor')
+    parser.add_argument('--seperator', type=str, default=' ')
+    parser.add_argument('--num_workers', type=int, default=8)
+    return parser
+
+
+def main(args):
+    output = args.output if args.output is not None else default_memmap_path(args.list_file)
+    build_memmap(args.data_dir, args.list_file, output, args.short_side, args.seperator, args.num_workers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('Frame store script', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
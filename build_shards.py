@@ -0,0 +1,124 @@
+import argparse
+import io
+import json
+import os
+import random
+import tarfile
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from sifar_pytorch.video_dataset import write_pack_to, default_shard_index_path
+
+
+def _read_video(args):
+    i, path, start_frame, end_frame, labels, data_dir, image_tmpl, modality = args
+    full_path = os.path.join(data_dir, path)
+    try:
+        if os.path.isdir(full_path):
+            # frame folder, its frames are packed into one member
+            frames = []
+            for idx in range(start_frame, end_frame + 1):
+                names = ["x_" + image_tmpl.format(idx), "y_" + image_tmpl.format(idx)] if modality == 'flow' \
+                    else [image_tmpl.format(idx)]
+                for name in names:
+                    with open(os.path.join(full_path, name), 'rb') as f:
+                        frames.append(f.read())
+            buf = io.BytesIO()
+            write_pack_to(buf, frames, start_frame, 2 if modality == 'flow' else 1)
+            video_format, video = 'pack', buf.getvalue()
+        else:
+            with open(full_path, 'rb') as f:
+                video = f.read()
+            video_format = os.path.splitext(path)[1].lstrip('.').lower() or 'video'
+    except Exception as e:
+        print("Failed to read {}: {}".format(full_path, e), flush=True)
+        return i, None, None
+    meta = {'path': path, 'start_frame': start_frame, 'end_frame': end_frame, 'label': labels,
+            'format': video_format}
+    return i, meta, video
+
+
+def _add_member(tar, name, buf):
+    info = tarfile.TarInfo(name)
+    info.size = len(buf)
+    info.mtime = time.time()
+    tar.addfile(info, io.BytesIO(buf))
+
+
+def build_shards(data_dir, list_file, output, image_tmpl='{:05d}.jpg', modality='rgb', seperator=' ',
+                 num_workers=8, shard_size=1024, shuffle=True, seed=0):
+    videos = []
+    for x in open(list_file):
+        elements = x.strip().split(seperator)
+        if len(elements) >= 3:
+            videos.append((elements[0], int(elements[1]), int(elements[2]), [float(l) for l in elements[3:]]))
+    multi_label = bool(np.mean(np.asarray([len(v[3]) + 3 for v in videos])) > 4.0)
+    if shuffle:
+        # the shards are read sequentially, mix the classes across them
+        random.Random(seed).shuffle(videos)
+
+    shard_dir = os.path.splitext(output)[0]
+    os.makedirs(shard_dir, exist_ok=True)
+    shard_name = os.path.basename(shard_dir) + '/shard-{:05d}.tar'
+    jobs = [(i, path, start_frame, end_frame, labels, data_dir, image_tmpl, modality)
+            for i, (path, start_frame, end_frame, labels) in enumerate(videos)]
+    shards = []
+    tar, shard_bytes, num_failed = None, 0, 0
+    start = time.time()
+    with Pool(num_workers) as pool:
+        for i, meta, video in pool.imap(_read_video, jobs, chunksize=4):
+            if meta is None:
+                num_failed += 1
+                continue
+            if tar is None or shard_bytes >= shard_size * 1024 ** 2:
+                if tar is not None:
+                    tar.close()
+                shards.append({'name': shard_name.format(len(shards)), 'num_videos': 0})
+                tar = tarfile.open(os.path.join(os.path.dirname(output), shards[-1]['name']), mode='w')
+                shard_bytes = 0
+            _add_member(tar, '{:08d}.json'.format(i), json.dumps(meta).encode('utf-8'))
+            _add_member(tar, '{:08d}.{}'.format(i, meta['format']), video)
+            shards[-1]['num_videos'] += 1
+            shard_bytes += len(video)
+            if (i + 1) % 1000 == 0:
+                print("Written {}/{} videos to {} shards ({:.1f}s)".format(
+                    i + 1, len(jobs), len(shards), time.time() - start), flush=True)
+    if tar is not None:
+        tar.close()
+
+    with open(output, 'w') as f:
+        json.dump({'list_file': os.path.basename(list_file), 'multi_label': multi_label, 'shards': shards}, f, indent=1)
+    print("Saved {} videos (failed: {}) in {} shards, index {}".format(
+        sum([x['num_videos'] for x in shards]), num_failed, len(shards), output))
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Shard script', add_help=False)
+    parser.add_argument('--data_dir', type=str, default='',
+                        help='path to the frame folders or videos, prefixed to the list entries')
+    parser.add_argument('--list_file', type=str, help='list file, each line with path, start_frame, end_frame, label_id')
+    parser.add_argument('--output', type=str, default=None,
+                        help='shard index, defaults to <list_file without extension>.shards.json, '
+                             'the shards are written to the folder <output without .json>')
+    parser.add_argument('--image_tmpl', type=str, default='{:05d}.jpg', help='template of the frames in a folder')
+    parser.add_argument('--modality', type=str, default='rgb', choices=['rgb', 'flow'])
+    parser.add_argument('--seperator', type=str, default=' ')
+    parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--shard_size', type=int, default=1024, help='approximate size of a shard in MB')
+    parser.add_argument('--no_shuffle', action='store_true', help='keep the order of the list file in the shards')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser
+
+
+def main(args):
+    output = args.output if args.output is not None else default_shard_index_path(args.list_file)
+    build_shards(args.data_dir, args.list_file, output, args.image_tmpl, args.modality, args.seperator,
+                 args.num_workers, args.shard_size, not args.no_shuffle, args.seed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('Shard script', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
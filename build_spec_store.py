@@ -0,0 +1,79 @@
+import argparse
+import os
+import time
+from multiprocessing import Pool
+
+import librosa
+import numpy as np
+
+from sifar_pytorch.video_dataset import compute_log_spectrogram, save_spectrogram_index
+
+
+def _compute(args):
+    path, audio_path, resampling_rate, window_size, step_size = args
+    try:
+        samples, _ = librosa.core.load(audio_path, sr=resampling_rate, mono=True)
+        spec = compute_log_spectrogram(samples, resampling_rate, window_size, step_size).astype(np.float32)
+    except Exception as e:
+        print("Failed to read {}: {}".format(audio_path, e), flush=True)
+        return path, None
+    return path, spec
+
+
+def build_spec_store(data_dir, list_file, output, resampling_rate=24000, window_size=10, step_size=5,
+                     seperator=' ', num_workers=8):
+    paths = []
+    for x in open(list_file):
+        elements = x.strip().split(seperator)
+        if len(elements) > 0 and elements[0] != '':
+            paths.append(elements[0])
+    paths = list(dict.fromkeys(paths))
+
+    jobs = [(path, os.path.join(data_dir, path), resampling_rate, window_size, step_size) for path in paths]
+    stored_paths, offsets, num_columns = [], [], []
+    num_bins = 0
+    offset = 0
+    start = time.time()
+    with Pool(num_workers) as pool, open(output, 'wb') as f:
+        for i, (path, spec) in enumerate(pool.imap(_compute, jobs, chunksize=1)):
+            if spec is not None and spec.shape[1] > 0:
+                f.write(np.ascontiguousarray(spec).tobytes())
+                stored_paths.append(path)
+                offsets.append(offset)
+                num_columns.append(spec.shape[1])
+                num_bins = spec.shape[0]
+                offset += spec.size
+            if (i + 1) % 100 == 0:
+                print("Computed {}/{} spectrograms, {:.1f} GB ({:.1f}s)".format(
+                    i + 1, len(jobs), offset * 4 / 1024 ** 3, time.time() - start), flush=True)
+
+    hop_length = int(round(step_size * resampling_rate / 1e3))
+    save_spectrogram_index(output, stored_paths, offsets, num_columns, num_bins, hop_length, resampling_rate)
+    print("Saved spectrograms of {} audio files (failed: {}) to {}".format(
+        len(stored_paths), len(paths) - len(stored_paths), output))
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Spectrogram store script', add_help=False)
+    parser.add_argument('--data_dir', type=str, default='', help='path to the audio files, prefixed to the list entries')
+    parser.add_argument('--list_file', type=str, help='list file, each line with path, start_frame, end_frame, label_id')
+    parser.add_argument('--output', type=str, default=None,
+                        help='spectrogram store, defaults to <list_file without extension>.spec (index in <output>.npz)')
+    parser.add_argument('--resampling_rate', type=int, default=24000)
+    parser.add_argument('--window_size', type=int, default=10, help='stft window in ms')
+    parser.add_argument('--step_size', type=int, default=5, help='stft hop in ms')
+    parser.add_argument('--seperator', type=str, default=' ')
+    parser.add_argument('--num_workers', type=int, default=8)
+    return parser
+
+
+def main(args):
+    output = args.output if args.output is not None else os.path.splitext(args.list_file)[0] + '.spec'
+    build_spec_store(args.data_dir, args.list_file, output, args.resampling_rate, args.window_size,
+                     args.step_size, args.seperator, args.num_workers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('Spectrogram store script', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,63 @@
+import argparse
+import os
+import time
+from multiprocessing import Pool
+
+from sifar_pytorch.video_dataset import probe_video_index, save_video_index, default_video_index_path
+
+
+def _probe(args):
+    path, video_path = args
+    try:
+        frame_pts, key_idx = probe_video_index(video_path)
+    except Exception as e:
+        print("Failed to index {}: {}".format(video_path, e), flush=True)
+        return path, None, None
+    return path, frame_pts, key_idx
+
+
+def build_video_index(data_dir, list_file, output, seperator=' ', num_workers=8):
+    paths = []
+    for x in open(list_file):
+        elements = x.strip().split(seperator)
+        if len(elements) > 0 and elements[0] != '':
+            paths.append(elements[0])
+    paths = list(dict.fromkeys(paths))
+
+    jobs = [(path, os.path.join(data_dir, path)) for path in paths]
+    indexed_paths, frame_pts_list, key_idx_list = [], [], []
+    start = time.time()
+    with Pool(num_workers) as pool:
+        for i, (path, frame_pts, key_idx) in enumerate(pool.imap(_probe, jobs, chunksize=16)):
+            if frame_pts is not None and len(frame_pts) > 0:
+                indexed_paths.append(path)
+                frame_pts_list.append(frame_pts)
+                key_idx_list.append(key_idx)
+            if (i + 1) % 1000 == 0:
+                print("Indexed {}/{} videos ({:.1f}s)".format(i + 1, len(jobs), time.time() - start), flush=True)
+
+    save_video_index(output, indexed_paths, frame_pts_list, key_idx_list)
+    print("Saved the index of {} videos (failed: {}) to {}".format(
+        len(indexed_paths), len(paths) - len(indexed_paths), output))
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Keyframe/PTS index script', add_help=False)
+    parser.add_argument('--data_dir', type=str, default='', help='path to the videos, prefixed to the list entries')
+    parser.add_argument('--list_file', type=str, help='list file, each line with path, start_frame, end_frame, label_id')
+    parser.add_argument('--output', type=str, default=None,
+                        help='index file, defaults to <list_file without extension>.index.npz')
+    parser.add_argument('--seperator', type=str, default=' ')
+    parser.add_argument('--num_workers', type=int, default=8)
+    return parser
+
+
+def main(args):
+    output = args.output if args.output is not None else default_video_index_path(args.list_file)
+    build_video_index(args.data_dir, args.list_file, output, args.seperator, args.num_workers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('Keyframe/PTS index script', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
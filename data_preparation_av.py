@@ -1,9 +1,18 @@
 import argparse
+import json
+import time
+from multiprocessing import Pool
 from pathlib import Path
 import cv2
 from ssl_sifar_utils import get_training_filenames, validate_split
 import os
 
+try:
+    import av
+    _HAS_PYAV = True
+except ImportError:
+    _HAS_PYAV = False
+
 def get_video_frame_count(video_path):
     cap = cv2.VideoCapture(video_path)
     if not cap.isOpened():
@@ -15,6 +24,109 @@ def get_video_frame_count(video_path):
     return frame_count
 
 
+def get_video_frame_count_av(video_path, tolerance=0.05, decode=False):
+    """Frame count from the container header, counted again when the header is missing or disagrees
+    with duration * frame rate by more than `tolerance`. The count is by decoding the frames when
+    `decode` is True, otherwise by demuxing the packets, which is faster but an approximation:
+    it can differ from the decodable frames of truncated or corrupt streams and of AVIs with packed
+    B-frames (e.g. xvid)."""
+    try:
+        container = av.open(video_path)
+    except Exception:
+        print("Error opening video file")
+        return None
+    try:
+        stream = container.streams.video[0]
+        frame_count = stream.frames
+        expected = None
+        if stream.duration is not None and stream.average_rate is not None:
+            expected = float(stream.duration * stream.time_base * stream.average_rate)
+        if frame_count <= 0 or expected is None or abs(frame_count - expected) > tolerance * max(expected, 1):
+            frame_count = 0
+            if decode:
+                try:
+                    for _ in container.decode(stream):
+                        frame_count += 1
+                except av.AVError:
+                    # a corrupt stream has as many frames as decoded before the error
+                    pass
+            else:
+                frame_count = sum([1 for packet in container.demux(stream) if packet.size > 0])
+    except Exception as e:
+        print("Error reading video file {}: {}".format(video_path, e))
+        return None
+    finally:
+        container.close()
+    return frame_count
+
+
+FRAME_COUNT_BACKENDS = ['cv2', 'pyav', 'pyav_decode']
+
+
+def _count_frames(args):
+    video_path, backend = args
+    if backend in ['pyav', 'pyav_decode']:
+        return get_video_frame_count_av(video_path, decode=backend == 'pyav_decode')
+    return get_video_frame_count(video_path)
+
+
+def _cache_key(video_path):
+    stat = os.stat(video_path)
+    return [stat.st_size, stat.st_mtime]
+
+
+def _save_cache(cache, cache_file):
+    # written aside and renamed, an interrupted write keeps the previous cache
+    with open(cache_file + '.tmp', 'w') as fp:
+        json.dump(cache, fp)
+    os.replace(cache_file + '.tmp', cache_file)
+
+
+def count_video_frames(video_paths, num_workers=8, backend='cv2', cache_file=None, save_every=1000):
+    """
+    Frame counts of many videos with a process pool, counts of unchanged files (same size and mtime)
+    by the same backend are taken from `cache_file`, new counts are added to it every `save_every` videos.
+    """
+    cache = {}
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file, 'r') as fp:
+            cache = json.load(fp)
+        # counts are kept per backend, {backend: {path: [size, mtime, count]}}
+        cache = {b: v for b, v in cache.items() if b in FRAME_COUNT_BACKENDS}
+    backend_cache = cache.setdefault(backend, {})
+
+    counts = {}
+    todo = []
+    for vpath in dict.fromkeys(video_paths):
+        try:
+            key = _cache_key(vpath)
+        except OSError:
+            key = None
+        entry = backend_cache.get(vpath, None)
+        if key is not None and entry is not None and entry[:2] == key:
+            counts[vpath] = entry[2]
+        else:
+            todo.append((vpath, key))
+    print("{} videos, {} counted before, counting {} with {} workers".format(
+        len(counts) + len(todo), len(counts), len(todo), num_workers), flush=True)
+
+    start = time.time()
+    with Pool(num_workers) as pool:
+        results = pool.imap(_count_frames, [(vpath, backend) for vpath, _ in todo], chunksize=16)
+        for i, ((vpath, key), fcount) in enumerate(zip(todo, results)):
+            counts[vpath] = fcount
+            if key is not None and fcount is not None:
+                backend_cache[vpath] = key + [fcount]
+            if (i + 1) % save_every == 0:
+                print("Counted {}/{} videos ({:.1f}s)".format(i + 1, len(todo), time.time() - start), flush=True)
+                if cache_file is not None:
+                    _save_cache(cache, cache_file)
+
+    if cache_file is not None and len(todo) > 0:
+        _save_cache(cache, cache_file)
+    return [counts[vpath] for vpath in video_paths]
+
+
 
 def create_label_dict(path):
     with open(path, 'r') as fp:
@@ -26,18 +138,17 @@ def create_label_dict(path):
         
     return label_to_idx
 
-def create_train_val_list(dataset_root, listpath, label_to_idx, output_dir):
+def create_train_val_list(dataset_root, listpath, label_to_idx, output_dir, **count_kwargs):
     
     with open(listpath, 'r') as fp:
         lines = fp.readlines()
         train_list = []
         count = 0
         print("Please Wait...")
-        for line in lines:
-            vpath = line.split()[0]
-            label = vpath.split('/')[0]
-            vpath = dataset_root + vpath
-            fcount = get_video_frame_count(vpath)
+        vpaths = [dataset_root + line.split()[0] for line in lines]
+        fcounts = count_video_frames(vpaths, **count_kwargs)
+        for line, vpath, fcount in zip(lines, vpaths, fcounts):
+            label = line.split()[0].split('/')[0]
             train_list += [[vpath, str(1), str(fcount), str(label_to_idx[label])]]
             
 
@@ -50,17 +161,16 @@ def create_train_val_list(dataset_root, listpath, label_to_idx, output_dir):
        
             
 
-def create_test_list(dataset_root, listpath, label_to_idx, output_dir):
+def create_test_list(dataset_root, listpath, label_to_idx, output_dir, **count_kwargs):
      with open(listpath, 'r') as fp:
         lines = fp.readlines()
         test_list = []
         count = 0
         print('Please Wait...')
-        for line in lines:
-            vpath = line.split()[0]
-            label = vpath.split('/')[0]
-            vpath = dataset_root + vpath
-            fcount = get_video_frame_count(vpath)
+        vpaths = [dataset_root + line.split()[0] for line in lines]
+        fcounts = count_video_frames(vpaths, **count_kwargs)
+        for line, vpath, fcount in zip(lines, vpaths, fcounts):
+            label = line.split()[0].split('/')[0]
             test_list += [[vpath, str(1), str(fcount), str(label_to_idx[label])]]
             
 
@@ -76,6 +186,12 @@ def get_args_parser():
     parser.add_argument('--trainlist_path', type=str)
     parser.add_argument('--testlist_path', type=str)
     parser.add_argument('--percentage', type=int, default=10)
+    parser.add_argument('--num_workers', type=int, default=8, help='processes counting the frames')
+    parser.add_argument('--count_backend', type=str, default='cv2', choices=FRAME_COUNT_BACKENDS,
+                        help='[cv2] CAP_PROP_FRAME_COUNT, [pyav] container header, counted from the packets if it is wrong '
+                             '(approximate), [pyav_decode] container header, counted by decoding if it is wrong')
+    parser.add_argument('--frame_count_cache', type=str, default=None,
+                        help='cache of the frame counts, defaults to <output_dir>/frame_count_cache.json')
     return parser
 
 
@@ -86,8 +202,14 @@ def main(args):
     print(label_to_idx)
 
 
-    train_list = create_train_val_list(args.dataset_root, args.trainlist_path, label_to_idx, args.output_dir)
-    create_test_list(args.dataset_root, args.testlist_path, label_to_idx, args.output_dir)
+    if args.count_backend in ['pyav', 'pyav_decode'] and not _HAS_PYAV:
+        raise ValueError("--count_backend {} needs PyAV installed.".format(args.count_backend))
+    cache_file = args.frame_count_cache if args.frame_count_cache is not None \
+        else os.path.join(args.output_dir, 'frame_count_cache.json')
+    count_kwargs = dict(num_workers=args.num_workers, backend=args.count_backend, cache_file=cache_file)
+
+    train_list = create_train_val_list(args.dataset_root, args.trainlist_path, label_to_idx, args.output_dir, **count_kwargs)
+    create_test_list(args.dataset_root, args.testlist_path, label_to_idx, args.output_dir, **count_kwargs)
     train_list = os.path.join(args.output_dir, 'train.txt')
     train_label_list, train_unlabel_list = get_training_filenames(args.output_dir, train_list,(100 - args.percentage) / 100, 'classwise')
 
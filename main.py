@@ -6,6 +6,7 @@
 #
 import argparse
 import datetime
+import multiprocessing
 import numpy as np
 import time
 import torch
@@ -37,8 +38,10 @@ import torch.nn as nn
 from sifar_pytorch import utils
 from sifar_pytorch.losses import DeepMutualLoss, ONELoss, MulMixturelLoss, SelfDistillationLoss
 
-from sifar_pytorch.video_dataset import VideoDataSet, VideoDataSetLMDB, VideoDataSetOnline
-from sifar_pytorch.video_dataset_aug import get_augmentor, build_dataflow
+from sifar_pytorch.video_dataset import VideoDataSet, VideoDataSetLMDB, VideoDataSetOnline, VideoDataSetMemmap, SharedFrameCache, default_video_index_path, default_quarantine_path, \
+    VideoShardDataSet, default_shard_index_path, LatencyGuardDataSet
+from sifar_pytorch.video_dataset_aug import get_augmentor, build_dataflow, build_joint_dataflow, get_decode_short_side, \
+    WorkerThreadBudget
 from sifar_pytorch.video_dataset_config import get_dataset_config, DATASET_CONFIG
 
 from torch.optim.lr_scheduler import StepLR, CosineAnnealingLR
@@ -88,6 +91,50 @@ def get_args_parser():
                         choices=['rgb', 'flow'])
     parser.add_argument('--use_lmdb', action='store_true', help='use lmdb instead of jpeg.')
     parser.add_argument('--use_pyav', action='store_true', help='use video directly.')
+    parser.add_argument('--use_packed', action='store_true',
+                        help='[jpeg] read the frames of each folder from <folder>.pack (see pack_frames.py)')
+    parser.add_argument('--video_reader', default='pyav', type=str, choices=['pyav', 'torchvision', 'opencv', 'decord'],
+                        help='[pyav] video reader backend (see benchmark_readers.py to compare them on a list file)')
+    parser.add_argument('--use_shards', action='store_true',
+                        help='stream the training videos sequentially from the tar shards of each list file (see build_shards.py)')
+    parser.add_argument('--shuffle_buffer', default=100, type=int,
+                        help='[shards] number of encoded videos shuffled in memory per worker')
+    parser.add_argument('--use_memmap', action='store_true',
+                        help='read pre-decoded frames from the frame store next to each list file (see build_memmap.py)')
+    parser.add_argument('--use_video_index', action='store_true',
+                        help='[pyav] seek with the keyframe/PTS index next to each list file (see build_video_index.py)')
+    parser.add_argument('--use_quarantine', action='store_true',
+                        help='skip or remap the videos in the quarantine list next to each list file (see scan_dataset.py)')
+    parser.add_argument('--decode_at_scale', action='store_true',
+                        help='let the decoder resize the frames to the scale size of the augmentor '
+                             '(reduced-size decoding for large JPEGs)')
+    parser.add_argument('--transform_backend', default='pil', type=str, choices=['pil', 'array'],
+                        help='[pil] transform frame by frame, [array] transform the whole clip as one uint8 array')
+    parser.add_argument('--cycle_loader', default='labeled', type=str, choices=['labeled', 'unlabeled'],
+                        help='the loader iterated again until the other one ends, [labeled] for ucf/k400, [unlabeled] for hmdb')
+    parser.add_argument('--frame_cache_gb', default=0., type=float,
+                        help='shared memory (GB) caching the decoded frames of the labeled set across workers, 0 disables it')
+    parser.add_argument('--frame_cache_slot_kb', default=512, type=int,
+                        help='size of one cache slot (KB), larger frames are not cached')
+    parser.add_argument('--num_views', default=1, type=int,
+                        help='augment each decoded labeled clip this many times, with --repeated-aug each video is decoded once per epoch')
+    parser.add_argument('--batched_getitems', action='store_true',
+                        help='the train/val datasets load whole batches into one tensor (__getitems__)')
+    parser.add_argument('--joint_loader', action='store_true',
+                        help='load the labeled and unlabeled batches with one DataLoader and worker pool')
+    parser.add_argument('--worker_threads', default=0, type=int,
+                        help='threads of torch, opencv and the video decoder in each loader worker, '
+                             '0 splits the cores among the workers of all loaders, -1 keeps the library defaults')
+    parser.add_argument('--pin_workers', action='store_true', help='pin each loader worker to its own cores')
+    parser.add_argument('--report_worker_threads', action='store_true',
+                        help='print the effective threads of each loader worker when it starts')
+    parser.add_argument('--sample_budget', default=0., type=float,
+                        help='seconds a training sample may take, slower ones are replaced by a recent clip of the same class '
+                             'or another video and appended as skipped to the quarantine list of their list file '
+                             '(read by --use_quarantine in the next runs), 0 disables it. It is a soft limit, '
+                             'a sample blocked in native code (e.g. a decoder call) is only stopped when that call returns')
+    parser.add_argument('--uint8_transfer', action='store_true',
+                        help='workers return uint8 clips, float conversion and normalization are done per batch on the GPU')
 
     # temporal module
     parser.add_argument('--pretrained', action='store_true', default=False,
@@ -534,55 +581,139 @@ def main(args):
         video_data_cls = VideoDataSetLMDB
     elif args.use_pyav:
         video_data_cls = VideoDataSetOnline
+    elif args.use_memmap:
+        video_data_cls = VideoDataSetMemmap
     else:
         video_data_cls = VideoDataSet
 
+    def video_data_kwargs(list_file, is_train):
+        kwargs = {}
+        if args.use_packed and video_data_cls is VideoDataSet:
+            kwargs['packed'] = True
+        if args.use_pyav and args.use_video_index:
+            kwargs['video_index'] = default_video_index_path(list_file)
+        if args.use_pyav and args.video_reader != 'pyav':
+            kwargs['reader'] = args.video_reader
+        if args.transform_backend == 'array':
+            kwargs['clip_format'] = 'array'
+        if args.use_quarantine and os.path.exists(default_quarantine_path(list_file)):
+            kwargs['quarantine'] = default_quarantine_path(list_file)
+        if args.decode_at_scale and not args.use_memmap:
+            kwargs['decode_short_side'] = get_decode_short_side(is_train, args.input_size, args.disable_scaleup,
+                                                                args.augmentor_ver, args.scale_range)
+        return kwargs
     
     ## Datasets and Dataloaders
 
+    if args.uint8_transfer and (args.threed_data or args.modality != 'rgb'):
+        raise ValueError("--uint8_transfer only supports 2D rgb data.")
+    batch_normalize = utils.BatchNormalize(mean, std) if args.uint8_transfer else None
+
     train_label_list = os.path.join(args.list_root, train_label_list_name)
     train_unlabel_list = os.path.join(args.list_root, train_unlabel_list_name)
     
 
+    # the labeled set is small and re-read every few steps against the unlabeled one
+    if args.frame_cache_gb > 0 and args.use_memmap:
+        raise ValueError("--frame_cache_gb does not apply to --use_memmap, its frames are already decoded.")
+    frame_cache = SharedFrameCache(args.frame_cache_gb * 1024 ** 3, args.frame_cache_slot_kb * 1024) \
+        if args.frame_cache_gb > 0 else None
+
     train_augmentor = get_augmentor(True, args.input_size, mean, std, threed_data=args.threed_data,
-                                    version=args.augmentor_ver, scale_range=args.scale_range, dataset=args.dataset, no_flip=args.no_flip)
-    dataset_labeled_train = video_data_cls(args.data_dir, train_label_list, args.duration, args.frames_per_group,
-                                   num_clips=args.num_clips,
-                                   modality=args.modality, image_tmpl=image_tmpl,
-                                   dense_sampling=args.dense_sampling,
-                                   transform=train_augmentor, is_train=True, test_mode=False,
-                                   seperator=filename_seperator, filter_video=filter_video,
-                                   frame_order=args.frame_order)
-
-    dataset_unlabeled_train = video_data_cls(args.data_dir, train_unlabel_list, args.duration, args.frames_per_group,
-                                    num_clips=args.num_clips,
-                                    modality=args.modality, image_tmpl=image_tmpl,
-                                    dense_sampling=args.dense_sampling,
-                                    transform=train_augmentor, is_train=True, test_mode=False,
-                                    seperator=filename_seperator, filter_video=filter_video,
-                                    frame_order=args.frame_order)
+                                    version=args.augmentor_ver, scale_range=args.scale_range, dataset=args.dataset, no_flip=args.no_flip,
+                                    backend=args.transform_backend, uint8_output=args.uint8_transfer)
+    if args.use_shards and (args.joint_loader or args.repeated_aug):
+        raise ValueError("--use_shards does not support --joint_loader or --repeated-aug.")
+    if args.use_shards:
+        # the training sets are read sequentially, the validation set keeps random access
+        decode_short_side = get_decode_short_side(True, args.input_size, args.disable_scaleup, args.augmentor_ver,
+                                                  args.scale_range) if args.decode_at_scale else None
+        dataset_labeled_train, dataset_unlabeled_train = [
+            VideoShardDataSet(default_shard_index_path(list_file), args.duration, args.frames_per_group,
+                              num_clips=args.num_clips, modality=args.modality, dense_sampling=args.dense_sampling,
+                              transform=train_augmentor, is_train=True, test_mode=False, filter_video=filter_video,
+                              num_views=num_views, shuffle_buffer=args.shuffle_buffer, seed=args.seed,
+                              decode_short_side=decode_short_side,
+                              clip_format='array' if args.transform_backend == 'array' else 'pil')
+            for list_file, num_views in [(train_label_list, args.num_views), (train_unlabel_list, 1)]]
+        for dataset in [dataset_labeled_train, dataset_unlabeled_train]:
+            dataset.set_epoch(args.start_epoch)
+    else:
+        dataset_labeled_train = video_data_cls(args.data_dir, train_label_list, args.duration, args.frames_per_group,
+                                       num_clips=args.num_clips,
+                                       modality=args.modality, image_tmpl=image_tmpl,
+                                       dense_sampling=args.dense_sampling,
+                                       transform=train_augmentor, is_train=True, test_mode=False,
+                                       seperator=filename_seperator, filter_video=filter_video,
+                                       frame_order=args.frame_order, num_views=args.num_views, frame_cache=frame_cache,
+                                       **video_data_kwargs(train_label_list, True))
+
+        dataset_unlabeled_train = video_data_cls(args.data_dir, train_unlabel_list, args.duration, args.frames_per_group,
+                                        num_clips=args.num_clips,
+                                        modality=args.modality, image_tmpl=image_tmpl,
+                                        dense_sampling=args.dense_sampling,
+                                        transform=train_augmentor, is_train=True, test_mode=False,
+                                        seperator=filename_seperator, filter_video=filter_video,
+                                        frame_order=args.frame_order, **video_data_kwargs(train_unlabel_list, True))
+
+    if args.sample_budget > 0:
+        if args.use_shards:
+            raise ValueError("--sample_budget does not support --use_shards.")
+        # the slow videos are appended to the quarantine list of their list file, see --use_quarantine
+        dataset_labeled_train = LatencyGuardDataSet(dataset_labeled_train, args.sample_budget,
+                                                    default_quarantine_path(train_label_list))
+        dataset_unlabeled_train = LatencyGuardDataSet(dataset_unlabeled_train, args.sample_budget,
+                                                      default_quarantine_path(train_unlabel_list))
+
+    # the workers of the persistent train loaders run together and split the cores, the validation loader
+    # starts its workers after the training epoch and has all the cores
+    num_loader_workers = min(args.num_workers, multiprocessing.cpu_count())
+    num_train_loaders = 1 if args.joint_loader else 2
+
+    def worker_init_fn_of(loader_idx, num_loaders=num_train_loaders):
+        if args.worker_threads < 0:
+            return None
+        return WorkerThreadBudget(args.worker_threads, args.pin_workers, args.report_worker_threads,
+                                  total_workers=num_loaders * num_loader_workers,
+                                  worker_offset=loader_idx * num_loader_workers)
 
     num_tasks = utils.get_world_size()
-    labeled_trainloader = build_dataflow(dataset_labeled_train, is_train=True, batch_size=args.batch_size,
-                                       workers=args.num_workers, is_distributed=args.distributed, drop_last=args.drop_last)
+    if args.joint_loader:
+        if args.distributed or args.repeated_aug or args.num_views > 1:
+            raise ValueError("--joint_loader does not support distributed training, --repeated-aug or --num_views.")
+        labeled_trainloader = build_joint_dataflow(dataset_labeled_train, dataset_unlabeled_train, args.batch_size,
+                                                   args.mu, workers=args.num_workers, drop_last=args.drop_last,
+                                                   sup_thresh=args.sup_thresh, cycle_loader=args.cycle_loader,
+                                                   worker_init_fn=worker_init_fn_of(0))
+        unlabeled_trainloader = None
+    else:
+        labeled_trainloader = build_dataflow(dataset_labeled_train, is_train=True, batch_size=args.batch_size,
+                                           workers=args.num_workers, is_distributed=args.distributed, drop_last=args.drop_last,
+                                           persistent_workers=True, repeated_aug=args.repeated_aug, num_views=args.num_views,
+                                           batched_getitems=args.batched_getitems, worker_init_fn=worker_init_fn_of(0))
 
-    unlabeled_trainloader = build_dataflow(dataset_unlabeled_train, is_train=True, batch_size=(args.batch_size * args.mu),
-                                       workers=args.num_workers, is_distributed=args.distributed, drop_last=args.drop_last)
+        unlabeled_trainloader = build_dataflow(dataset_unlabeled_train, is_train=True, batch_size=(args.batch_size * args.mu),
+                                           workers=args.num_workers, is_distributed=args.distributed, drop_last=args.drop_last,
+                                           persistent_workers=True, batched_getitems=args.batched_getitems,
+                                           worker_init_fn=worker_init_fn_of(1))
 
     val_list = os.path.join(args.list_root, val_list_name)
     val_augmentor = get_augmentor(False, args.input_size, mean, std, args.disable_scaleup,
                                   threed_data=args.threed_data, version=args.augmentor_ver,
-                                  scale_range=args.scale_range, num_clips=args.num_clips, num_crops=args.num_crops, dataset=args.dataset, no_flip=args.no_flip)
+                                  scale_range=args.scale_range, num_clips=args.num_clips, num_crops=args.num_crops, dataset=args.dataset, no_flip=args.no_flip,
+                                  backend=args.transform_backend, uint8_output=args.uint8_transfer)
     dataset_val = video_data_cls(args.data_dir, val_list, args.duration, args.frames_per_group,
                                  num_clips=args.num_clips,
                                  modality=args.modality, image_tmpl=image_tmpl,
                                  dense_sampling=args.dense_sampling,
                                  transform=val_augmentor, is_train=False, test_mode=False,
                                  seperator=filename_seperator, filter_video=filter_video, frame_order=args.frame_order,
-                                 )
+                                 **video_data_kwargs(val_list, False))
 
     data_loader_val = build_dataflow(dataset_val, is_train=False, batch_size=args.test_batch_size,
-                                     workers=args.num_workers, is_distributed=args.distributed, drop_last=args.drop_last)
+                                     workers=args.num_workers, is_distributed=args.distributed, drop_last=args.drop_last,
+                                     batched_getitems=args.batched_getitems,
+                                     worker_init_fn=worker_init_fn_of(0, num_loaders=1))
 
 
     #saving the sample superimage from data loader
@@ -592,13 +723,15 @@ def main(args):
     # save_super_image_from_dataloader(data_loader_unlabeled_train, sample_si_root, "unlabeled.jpg", False, args.input_size, args.super_img_rows)
 
     if args.classwise_eval:
-        test_stats = evaluate(data_loader_val, model, device, num_tasks, distributed=args.distributed, amp=args.amp, num_crops=args.num_crops, num_clips=args.num_clips, args=args, classwise=True)
+        test_stats = evaluate(data_loader_val, model, device, num_tasks, distributed=args.distributed, amp=args.amp, num_crops=args.num_crops, num_clips=args.num_clips, args=args, classwise=True,
+                              batch_normalize=batch_normalize)
         print(f"Accuracy of the network on the {len(dataset_val)} test images: {test_stats['acc1']:.1f}%")
         return
 
 
     if args.eval:
-        test_stats = evaluate(data_loader_val, model, device, num_tasks, distributed=args.distributed, amp=args.amp, num_crops=args.num_crops, num_clips=args.num_clips, args=args)
+        test_stats = evaluate(data_loader_val, model, device, num_tasks, distributed=args.distributed, amp=args.amp, num_crops=args.num_crops, num_clips=args.num_clips, args=args,
+                              batch_normalize=batch_normalize)
         print(f"Accuracy of the network on the {len(dataset_val)} test images: {test_stats['acc1']:.1f}%")
         return
     # test_stats = evaluate(data_loader_val, model, device, num_tasks, distributed=args.distributed, amp=args.amp, num_crops=args.num_crops, num_clips=args.num_clips, args=args)
@@ -610,9 +743,10 @@ def main(args):
    
     for epoch in range(args.start_epoch, args.epochs):
 
-        if args.distributed:
-            labeled_trainloader.sampler.set_epoch(epoch)
-            unlabeled_trainloader.sampler.set_epoch(epoch)
+        # also without distributed training, RASampler shuffles by the epoch number
+        for loader in [labeled_trainloader, unlabeled_trainloader]:
+            if loader is not None and hasattr(loader.sampler, 'set_epoch'):
+                loader.sampler.set_epoch(epoch)
         
         start_time = time.time()
         train_stats = train_one_epoch(
@@ -628,14 +762,18 @@ def main(args):
             byol_criterion=byol_criterion, byol_w=args.byol_w,
             contrastive_nomixup=args.contrastive_nomixup,
             hard_contrastive=args.hard_contrastive,
-            finetune=args.finetune
+            finetune=args.finetune,
+            batch_normalize=batch_normalize
         )
         end_time = time.time()
         _logger.info(f"Epoch: {epoch}, Time: {(end_time - start_time) / 60}, Fastbackprop: {args.fast_backprop}")
         lr_sched_cosine.step(epoch)
         
-        test_stats = evaluate(data_loader_val, model, device, num_tasks, distributed=args.distributed, amp=args.amp, args=args)
+        test_stats = evaluate(data_loader_val, model, device, num_tasks, distributed=args.distributed, amp=args.amp, args=args,
+                              batch_normalize=batch_normalize)
         print(f"Accuracy of the network on the {len(dataset_val)} test images: {test_stats['acc1']:.1f}%")
+        if frame_cache is not None:
+            print("Frame cache: {}".format(frame_cache.stats()))
 
         # added for LR on Platetue
         # lr_sched_cosine.step(test_stats['loss'], epoch)
@@ -0,0 +1,71 @@
+import argparse
+import os
+import time
+from multiprocessing import Pool
+
+from sifar_pytorch.video_dataset import write_pack, PACK_SUFFIX
+
+
+def _pack_folder(args):
+    folder, start_frame, end_frame, image_tmpl, modality, overwrite = args
+    pack_path = folder.rstrip('/') + PACK_SUFFIX
+    if not overwrite and os.path.exists(pack_path):
+        return folder, 'skipped'
+    try:
+        frames = []
+        for i in range(start_frame, end_frame + 1):
+            names = ["x_" + image_tmpl.format(i), "y_" + image_tmpl.format(i)] if modality == 'flow' \
+                else [image_tmpl.format(i)]
+            for name in names:
+                with open(os.path.join(folder, name), 'rb') as f:
+                    frames.append(f.read())
+        write_pack(pack_path + '.tmp', frames, start_frame, 2 if modality == 'flow' else 1)
+        os.replace(pack_path + '.tmp', pack_path)
+    except Exception as e:
+        print("Failed to pack {}: {}".format(folder, e), flush=True)
+        return folder, 'failed'
+    return folder, 'packed'
+
+
+def pack_frames(data_dir, list_file, image_tmpl='{:05d}.jpg', modality='rgb', seperator=' ', num_workers=8,
+                overwrite=False):
+    folders = {}
+    for x in open(list_file):
+        elements = x.strip().split(seperator)
+        if len(elements) >= 3:
+            folders[os.path.join(data_dir, elements[0])] = (int(elements[1]), int(elements[2]))
+
+    jobs = [(folder, start_frame, end_frame, image_tmpl, modality, overwrite)
+            for folder, (start_frame, end_frame) in folders.items()]
+    counts = {'packed': 0, 'skipped': 0, 'failed': 0}
+    start = time.time()
+    with Pool(num_workers) as pool:
+        for i, (_, status) in enumerate(pool.imap_unordered(_pack_folder, jobs, chunksize=8)):
+            counts[status] += 1
+            if (i + 1) % 1000 == 0:
+                print("Packed {}/{} folders ({:.1f}s)".format(i + 1, len(jobs), time.time() - start), flush=True)
+    print("Packed {packed}, skipped {skipped} existing, failed {failed} folders".format(**counts))
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Frame packing script', add_help=False)
+    parser.add_argument('--data_dir', type=str, default='',
+                        help='prefixed to the folders in the list file, the same as --data_dir of main.py')
+    parser.add_argument('--list_file', type=str, help='list file, each line with folder_path, start_frame, end_frame, label_id')
+    parser.add_argument('--image_tmpl', type=str, default='{:05d}.jpg')
+    parser.add_argument('--modality', type=str, default='rgb', choices=['rgb', 'flow'])
+    parser.add_argument('--seperator', type=str, default=' ')
+    parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--overwrite', action='store_true', help='pack again the folders with a .pack file')
+    return parser
+
+
+def main(args):
+    pack_frames(args.data_dir, args.list_file, args.image_tmpl, args.modality, args.seperator,
+                args.num_workers, args.overwrite)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('Frame packing script', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
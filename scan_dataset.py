@@ -0,0 +1,143 @@
+import argparse
+import json
+import os
+import time
+from multiprocessing import Pool
+
+import av
+from PIL import Image
+
+from sifar_pytorch.video_dataset import save_quarantine, default_quarantine_path
+
+
+def _scan_folder(full_path, start_frame, end_frame, image_tmpl, modality):
+    # frames are counted up to the first missing or undecodable one, like a truncated extraction
+    true_frames = 0
+    for i in range(start_frame, end_frame + 1):
+        names = ["x_" + image_tmpl.format(i), "y_" + image_tmpl.format(i)] if modality == 'flow' \
+            else [image_tmpl.format(i)]
+        try:
+            for name in names:
+                with Image.open(os.path.join(full_path, name)) as img:
+                    img.load()
+        except Exception as e:
+            return true_frames, "unreadable frame {}: {}".format(i, e)
+        true_frames += 1
+    return true_frames, ''
+
+
+def _scan_video(full_path):
+    reasons = []
+    container = av.open(full_path)
+    stream = container.streams.video[0]
+    stream.thread_type = "AUTO"
+    frames_length = stream.frames
+    duration = stream.duration
+    if duration is None or frames_length == 0:
+        # VideoDataSetOnline decodes the whole video for every clip
+        reasons.append('no stream frames/duration, decode_all')
+    else:
+        # the seek of the selective decoding, to the middle of the video
+        try:
+            container.seek(int(frames_length // 2 * duration / frames_length), any_frame=False, backward=True,
+                           stream=stream)
+            next(container.decode({'video': 0}))
+        except Exception as e:
+            reasons.append('seek failed, decode_all: {}'.format(e))
+        container.seek(0, any_frame=False, backward=True, stream=stream)
+
+    all_pts = set()
+    try:
+        for frame in container.decode({'video': 0}):
+            all_pts.add(frame.pts)
+    except Exception as e:
+        reasons.append('decoding stopped after {} frames: {}'.format(len(all_pts), e))
+    container.close()
+    true_frames = len(all_pts)
+    if frames_length not in [0, None] and frames_length != true_frames:
+        reasons.append('stream reports {} frames'.format(frames_length))
+    return true_frames, '; '.join(reasons)
+
+
+def _scan(args):
+    path, start_frame, end_frame, data_dir, image_tmpl, modality = args
+    full_path = os.path.join(data_dir, path)
+    start = time.time()
+    try:
+        if os.path.isdir(full_path):
+            true_frames, reason = _scan_folder(full_path, start_frame, end_frame, image_tmpl, modality)
+        else:
+            true_frames, reason = _scan_video(full_path)
+    except Exception as e:
+        true_frames, reason = 0, 'unreadable: {}'.format(e)
+    return {'path': path, 'listed_frames': end_frame - start_frame + 1, 'true_frames': true_frames,
+            'decode_sec': time.time() - start, 'reason': reason}
+
+
+def scan_dataset(data_dir, list_file, output, report=None, image_tmpl='{:05d}.jpg', modality='rgb', seperator=' ',
+                 num_workers=8, max_decode_sec=None):
+    videos = {}
+    for x in open(list_file):
+        elements = x.strip().split(seperator)
+        if len(elements) >= 3:
+            videos[elements[0]] = (int(elements[1]), int(elements[2]))
+
+    jobs = [(path, start_frame, end_frame, data_dir, image_tmpl, modality)
+            for path, (start_frame, end_frame) in videos.items()]
+    results, entries = [], []
+    start = time.time()
+    with Pool(num_workers) as pool:
+        for i, result in enumerate(pool.imap_unordered(_scan, jobs, chunksize=1)):
+            results.append(result)
+            if result['true_frames'] == 0:
+                entries.append((result['path'], 'skip', 0, result['reason']))
+            elif max_decode_sec is not None and result['decode_sec'] > max_decode_sec:
+                entries.append((result['path'], 'skip', result['true_frames'],
+                                'slow: {:.1f}s; {}'.format(result['decode_sec'], result['reason'])))
+            elif result['true_frames'] != result['listed_frames']:
+                entries.append((result['path'], 'remap', result['true_frames'],
+                                'listed {} frames; {}'.format(result['listed_frames'], result['reason'])))
+            if (i + 1) % 1000 == 0:
+                print("Scanned {}/{} videos, {} quarantined ({:.1f}s)".format(
+                    i + 1, len(jobs), len(entries), time.time() - start), flush=True)
+
+    save_quarantine(output, sorted(entries))
+    if report is not None:
+        with open(report, 'w') as f:
+            json.dump(sorted(results, key=lambda r: r['path']), f, indent=1)
+    decode_sec = sorted([r['decode_sec'] for r in results])
+    num_skipped = sum([1 for e in entries if e[1] == 'skip'])
+    print("Scanned {} videos, decode time median {:.3f}s max {:.3f}s".format(
+        len(results), decode_sec[len(decode_sec) // 2] if decode_sec else 0., decode_sec[-1] if decode_sec else 0.))
+    print("Quarantined {} videos (skip: {}, remap: {}) to {}".format(
+        len(entries), num_skipped, len(entries) - num_skipped, output))
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Dataset scanning script', add_help=False)
+    parser.add_argument('--data_dir', type=str, default='',
+                        help='path to the frame folders or videos, prefixed to the list entries')
+    parser.add_argument('--list_file', type=str, help='list file, each line with path, start_frame, end_frame, label_id')
+    parser.add_argument('--output', type=str, default=None,
+                        help='quarantine list, defaults to <list_file without extension>.quarantine')
+    parser.add_argument('--report', type=str, default=None,
+                        help='json with the frame count, decode time and reason of every video')
+    parser.add_argument('--image_tmpl', type=str, default='{:05d}.jpg', help='template of the frames in a folder')
+    parser.add_argument('--modality', type=str, default='rgb', choices=['rgb', 'flow'])
+    parser.add_argument('--seperator', type=str, default=' ')
+    parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--max_decode_sec', type=float, default=None,
+                        help='also skip the videos taking longer than this to read entirely')
+    return parser
+
+
+def main(args):
+    output = args.output if args.output is not None else default_quarantine_path(args.list_file)
+    scan_dataset(args.data_dir, args.list_file, output, args.report, args.image_tmpl, args.modality,
+                 args.seperator, args.num_workers, args.max_decode_sec)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('Dataset scanning script', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
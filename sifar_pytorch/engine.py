@@ -25,8 +25,8 @@ from timm.utils import accuracy, ModelEma, reduce_tensor
 from .utils import *
 from .utils import save_super_image, create_super_image
 from .losses import DeepMutualLoss, ONELoss, SelfDistillationLoss
+from .video_dataset_aug import InfiniteLoader
 from collections import defaultdict 
-from itertools import cycle
 import torch.nn.functional as F
 
 import logging
@@ -47,7 +47,8 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
                     byol_criterion=None, byol_w=0.,
                     contrastive_nomixup=False, hard_contrastive=False,
                     finetune=False,
-                    args=None
+                    args=None,
+                    batch_normalize=None
                     ):
 
     def process_samples_target(samples, targets):
@@ -90,11 +91,20 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
 
     #criterion.train()
 
-    lenn = max(len(labeled_trainloader), len(unlabeled_trainloader))
-    if epoch >= args.sup_thresh:
-        data_loader = zip(cycle(labeled_trainloader), unlabeled_trainloader)    #ucf, k400
-        # data_loader = zip(labeled_trainloader, cycle(unlabeled_trainloader))    #hmdb
+    if unlabeled_trainloader is None:
+        # a joint loader yields both batches (see build_joint_dataflow)
+        labeled_trainloader.batch_sampler.set_epoch(epoch)
+        lenn = len(labeled_trainloader)
+        data_loader = labeled_trainloader
+    elif epoch >= args.sup_thresh:
+        lenn = max(len(labeled_trainloader), len(unlabeled_trainloader))
+        # the shorter side is repeated until the longer one ends
+        if getattr(args, 'cycle_loader', 'labeled') == 'labeled':
+            data_loader = zip(InfiniteLoader(labeled_trainloader), unlabeled_trainloader)    #ucf, k400
+        else:
+            data_loader = zip(labeled_trainloader, InfiniteLoader(unlabeled_trainloader))    #hmdb
     else:
+        lenn = max(len(labeled_trainloader), len(unlabeled_trainloader))
         data_loader = labeled_trainloader
     ## Average meter changed to SmoothedValue
     ## removed by aftab, because it is already in add_meter
@@ -143,7 +153,7 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
             # samples_u, _ = process_samples_target(samples_u, targets)
 
             # print("sample target ", samples_u.shape, targets.shape)
-            super_image_3x3, super_image_2x2 = create_super_image(samples_u, isLabeled=False)
+            super_image_3x3, super_image_2x2 = create_super_image(samples_u, isLabeled=False, normalize=batch_normalize)
             # print(super_image_3x3.shape)
             # print(super_image_2x2.shape)
 
@@ -158,6 +168,9 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
         samples, targets = labeled_data
         samples = samples.cuda()
         targets = targets.cuda()
+        if batch_normalize is not None:
+            # mixup blends float pixels, so uint8 batches are normalized before it
+            samples = batch_normalize(samples)
 
         samples, targets = process_samples_target(samples, targets)
         # print("sample lab", samples.shape, targets.shape)
@@ -321,7 +334,8 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
 
 
 @torch.no_grad()
-def evaluate(data_loader, model, device, world_size, args, distributed=True, amp=False, num_crops=1, num_clips=1, classwise=False):
+def evaluate(data_loader, model, device, world_size, args, distributed=True, amp=False, num_crops=1, num_clips=1, classwise=False,
+             batch_normalize=None):
     criterion = torch.nn.CrossEntropyLoss()
 
     metric_logger = MetricLogger(delimiter="  ")
@@ -345,7 +359,7 @@ def evaluate(data_loader, model, device, world_size, args, distributed=True, amp
         batch_size = images.shape[0]
         #images = images.view((batch_size * num_crops * num_clips, -1) + images.size()[2:])
         # with torch.cuda.amp.autocast(enabled=amp):
-        super_image_val = create_super_image(images, isLabeled=True)
+        super_image_val = create_super_image(images, isLabeled=True, normalize=batch_normalize)
         output = model(super_image_val)
 
         # output = torch.rand((60, 101))
@@ -15,9 +15,12 @@ class RASampler(torch.utils.data.Sampler):
     It ensures that different each augmented version of a sample will be visible to a
     different process (GPU)
     Heavily based on torch.utils.data.DistributedSampler
+
+    With decode_once, the dataset returns num_repeats augmented views of every index (num_views),
+    so each index is drawn once and all its views stay on the same process.
     """
 
-    def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True):
+    def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True, num_repeats=3, decode_once=False):
         if num_replicas is None:
             if not dist.is_available():
                 raise RuntimeError("Requires distributed package to be available")
@@ -30,10 +33,12 @@ class RASampler(torch.utils.data.Sampler):
         self.num_replicas = num_replicas
         self.rank = rank
         self.epoch = 0
-        self.num_samples = int(math.ceil(len(self.dataset) * 3.0 / self.num_replicas))
+        self.num_repeats = num_repeats
+        self.decode_once = decode_once
+        self.num_samples = int(math.ceil(len(self.dataset) * float(num_repeats) / self.num_replicas))
         self.total_size = self.num_samples * self.num_replicas
-        # self.num_selected_samples = int(math.ceil(len(self.dataset) / self.num_replicas))
-        self.num_selected_samples = int(math.floor(len(self.dataset) // 256 * 256 / self.num_replicas))
+        # every (padded) repeat is kept, rounding down to a multiple of 256 left nothing of small labeled splits
+        self.num_selected_samples = self.num_samples
         self.shuffle = shuffle
 
     def __iter__(self):
@@ -45,8 +50,14 @@ class RASampler(torch.utils.data.Sampler):
         else:
             indices = list(range(len(self.dataset)))
 
+        if self.decode_once:
+            # the same number of views as below, num_repeats of them from each index
+            indices += indices[:(-len(indices)) % self.num_replicas]
+            indices = indices[self.rank::self.num_replicas]
+            return iter(indices[:len(self)])
+
         # add extra samples to make it evenly divisible
-        indices = [ele for ele in indices for i in range(3)]
+        indices = [ele for ele in indices for i in range(self.num_repeats)]
         indices += indices[:(self.total_size - len(indices))]
         assert len(indices) == self.total_size
 
@@ -57,6 +68,8 @@ class RASampler(torch.utils.data.Sampler):
         return iter(indices[:self.num_selected_samples])
 
     def __len__(self):
+        if self.decode_once:
+            return int(math.ceil(len(self.dataset) / self.num_replicas))
         return self.num_selected_samples
 
     def set_epoch(self, epoch):
@@ -291,6 +291,28 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
+class BatchNormalize(object):
+    """Float conversion and mean/std normalization of a uint8 batch (B x (T x C) x H x W), the
+    per-batch counterpart of ToTorchFormatTensor + GroupNormalize for loaders with uint8 output.
+    """
+    def __init__(self, mean=None, std=None):
+        mean = [0.485, 0.456, 0.406] if mean is None else mean
+        std = [0.229, 0.224, 0.225] if std is None else std
+        # (x / 255 - mean) / std == (x - 255 * mean) / (255 * std)
+        self.mean = torch.tensor(mean, dtype=torch.float32).mul_(255).view(1, 1, -1, 1, 1)
+        self.std = torch.tensor(std, dtype=torch.float32).mul_(255).view(1, 1, -1, 1, 1)
+
+    def __call__(self, x):
+        if x.is_floating_point():
+            return x
+        if self.mean.device != x.device:
+            self.mean, self.std = self.mean.to(x.device), self.std.to(x.device)
+        b, tc, h, w = x.shape
+        c = self.mean.shape[2]
+        x = x.view(b, tc // c, c, h, w).float()
+        return x.sub_(self.mean).div_(self.std).view(b, tc, h, w)
+
+
 def save_super_image(x, output):
     root = "/scratch/20cs91r11/aftab/ssl-sifar-dgx/superimage"
     temp_img = x[0]
@@ -307,7 +329,9 @@ def save_super_image(x, output):
     image.save(path)
     print(f"Image saved {path}")
 
-def create_super_image(x, isLabeled=True):
+def create_super_image(x, isLabeled=True, normalize=None):
+    if normalize is not None:
+        x = normalize(x)
     large_nrow = math.ceil(math.sqrt(x.shape[1] / 3))
     small_nrow = large_nrow - 1
     
@@ -1,21 +1,49 @@
 import os
+import math
+import json
+import ctypes
+import hashlib
+import multiprocessing
+import struct
+import tarfile
+import contextlib
 import six
 from typing import Union
 import random
+import signal
+import threading
+import time
+from collections import OrderedDict
 
 import numpy as np
 import torch
 from PIL import Image
+import torch.distributed as dist
 import torch.utils.data as data
 
+from .video_readers import get_video_reader
+
 try:
     import lmdb
-    import pyarrow as pa
     _HAS_LMDB = True
 except ImportError as e:
     _HAS_LMDB = False
     _LMDB_ERROR_MSG = e
 
+try:
+    # only needed to read databases in the old pyarrow-serialized format
+    import pyarrow as pa
+    _HAS_PYARROW = True
+except ImportError as e:
+    _HAS_PYARROW = False
+    _PYARROW_ERROR_MSG = e
+
+try:
+    import soundfile
+    _HAS_SOUNDFILE = True
+except ImportError:
+    _HAS_SOUNDFILE = False
+
 try:
     import av
     _HAS_PYAV = True
@@ -51,7 +79,7 @@ def random_clip(video_frames, sampling_rate, frames_per_clip, fixed_offset=False
 
 
 def compute_img_diff(image_1, image_2, bound=255.0):
-    image_diff = np.asarray(image_1, dtype=np.float) - np.asarray(image_2, dtype=np.float)
+    image_diff = np.asarray(image_1, dtype=np.float64) - np.asarray(image_2, dtype=np.float64)
     image_diff += bound
     image_diff *= (255.0 / float(2 * bound))
     image_diff = image_diff.astype(np.uint8)
@@ -59,7 +87,46 @@ def compute_img_diff(image_1, image_2, bound=255.0):
     return image_diff
 
 
-def load_image(directory, image_tmpl, idx, modality):
+def compute_clip_diff(frames, frame_idx, idx):
+    """
+    `compute_img_diff` of frame k + 1 and frame k for every k in `idx`, in one int16 operation.
+
+    Args:
+        frames (np.ndarray): (N x H x W x C) uint8 frames, numbered by `frame_idx` (sorted)
+        frame_idx (np.ndarray): frame numbers of `frames`, including every k and k + 1
+        idx (list[int]): frame numbers k
+
+    Returns:
+        np.ndarray: (len(idx) x H x W x C) uint8 differences
+    """
+    idx = np.asarray(idx)
+    image_diff = frames[np.searchsorted(frame_idx, idx + 1)].astype(np.int16)
+    image_diff -= frames[np.searchsorted(frame_idx, idx)]
+    # (diff + 255) * 255 / 510 truncated
+    image_diff += 255
+    image_diff >>= 1
+    return image_diff.astype(np.uint8)
+
+
+def open_image(fp, short_side=None, mode=None):
+    """
+    Open and load an image. With `short_side`, a JPEG at least 2x larger is decoded at 1/2, 1/4 or
+    1/8 scale in the DCT domain (draft mode), then any image larger is resized to it.
+    """
+    img_tmp = Image.open(fp)
+    if short_side is not None and img_tmp.format == 'JPEG' and min(img_tmp.size) >= 2 * short_side:
+        ratio = short_side / min(img_tmp.size)
+        img_tmp.draft(mode if mode is not None else img_tmp.mode,
+                      (int(math.ceil(img_tmp.size[0] * ratio)), int(math.ceil(img_tmp.size[1] * ratio))))
+    img = img_tmp.convert(mode) if mode is not None else img_tmp.copy()
+    img_tmp.close()
+    if short_side is not None and min(img.size) > short_side:
+        ratio = short_side / min(img.size)
+        img = img.resize((int(img.size[0] * ratio + 0.5), int(img.size[1] * ratio + 0.5)), Image.BILINEAR)
+    return img
+
+
+def load_image(directory, image_tmpl, idx, modality, short_side=None, as_array=False):
     """
 
     :param root_path:
@@ -67,6 +134,8 @@ def load_image(directory, image_tmpl, idx, modality):
     :param image_tmpl:
     :param idx: if it is a list, load a batch of images
     :param modality:
+    :param short_side: decode the images at (about) this shorter side, see `open_image`
+    :param as_array: rgbdiff only, return one (T x H x W x C) uint8 array instead of PIL images
     :return:
     """
 
@@ -75,9 +144,7 @@ def load_image(directory, image_tmpl, idx, modality):
         num_try = 0
         while num_try < 10:
             try:
-                img_tmp = Image.open(img_path)
-                img = img_tmp.copy()
-                img_tmp.close()
+                img = open_image(img_path, short_side)
                 break
             except Exception as e:
                 print('[Will try load again] error loading image: {}, '
@@ -95,49 +162,215 @@ def load_image(directory, image_tmpl, idx, modality):
             image_path_file = os.path.join(directory, image_tmpl.format(i))
             out.append(_safe_load_image(image_path_file))
     elif modality == 'rgbdiff':
-        tmp = {}
         new_idx = np.unique(np.concatenate((np.asarray(idx), np.asarray(idx) + 1)))
-        for i in new_idx:
-            image_path_file = os.path.join(root_path, directory, image_tmpl.format(i))
-            tmp[i] = _safe_load_image(image_path_file)
-        for k in idx:
-            img_ = compute_img_diff(tmp[k + 1], tmp[k])
-            out.append(img_)
-        del tmp
+        frames = np.stack([np.asarray(_safe_load_image(os.path.join(directory, image_tmpl.format(i))))
+                           for i in new_idx])
+        out = compute_clip_diff(frames, new_idx, idx)
+        if not as_array:
+            out = [Image.fromarray(x) for x in out]
     elif modality == 'flow':
         for i in idx:
-            flow_x_name = os.path.join(root_path, directory, "x_" + image_tmpl.format(i))
-            flow_y_name = os.path.join(root_path, directory, "y_" + image_tmpl.format(i))
+            flow_x_name = os.path.join(directory, "x_" + image_tmpl.format(i))
+            flow_y_name = os.path.join(directory, "y_" + image_tmpl.format(i))
             out.extend([_safe_load_image(flow_x_name), _safe_load_image(flow_y_name)])
 
     return out
 
 
+# Packed frame file: all encoded images of a frame folder in one file,
+#   header  PACK_MAGIC, entries per frame (1 for rgb, 2 for flow x/y), first frame number, number of entries
+#   offsets (number of entries + 1) little-endian uint64, entry j is bytes [offsets[j], offsets[j + 1])
+#   data    concatenated encoded images
+PACK_MAGIC = b'SFPK'
+PACK_SUFFIX = '.pack'
+_PACK_HEADER = struct.Struct('<4sHIQ')
+
+
+def write_pack(pack_path, frames, first_idx=1, entries_per_frame=1):
+    """frames (list[bytes]): encoded images ordered by frame number (x, y of a frame for flow)"""
+    with open(pack_path, 'wb') as f:
+        write_pack_to(f, frames, first_idx, entries_per_frame)
+
+
+def write_pack_to(f, frames, first_idx=1, entries_per_frame=1):
+    """Same as `write_pack` to an open binary file."""
+    offsets = np.zeros(len(frames) + 1, dtype='<u8')
+    offsets[1:] = np.cumsum([len(x) for x in frames])
+    offsets += _PACK_HEADER.size + offsets.nbytes
+    f.write(_PACK_HEADER.pack(PACK_MAGIC, entries_per_frame, first_idx, len(frames)))
+    f.write(offsets.tobytes())
+    for x in frames:
+        f.write(x)
+
+
+def _load_packed(read, idx, modality, short_side=None, name='buffer', as_array=False):
+    # read(size, offset) returns the bytes of the packed frame file at offset
+    def _to_PIL(buf, is_flow=False):
+        return open_image(six.BytesIO(buf), short_side, 'RGB' if not is_flow else 'L')
+
+    if not isinstance(idx, list):
+        idx = [idx]
+    magic, entries_per_frame, first_idx, num_entries = _PACK_HEADER.unpack(read(_PACK_HEADER.size, 0))
+    if magic != PACK_MAGIC:
+        raise ValueError('{} is not a packed frame file'.format(name))
+    offsets = np.frombuffer(read((num_entries + 1) * 8, _PACK_HEADER.size), dtype='<u8')
+
+    def _read(entry):
+        return read(int(offsets[entry + 1] - offsets[entry]), int(offsets[entry]))
+
+    out = []
+    if modality == 'rgb':
+        bufs = {i: _read(i - first_idx) for i in sorted(set(idx))}
+        out = [_to_PIL(bufs[i]) for i in idx]
+    elif modality == 'rgbdiff':
+        new_idx = np.unique(np.concatenate((np.asarray(idx), np.asarray(idx) + 1)))
+        frames = np.stack([np.asarray(_to_PIL(_read(i - first_idx))) for i in new_idx])
+        out = compute_clip_diff(frames, new_idx, idx)
+        if not as_array:
+            out = [Image.fromarray(x) for x in out]
+    elif modality == 'flow':
+        for i in idx:
+            entry = (i - first_idx) * entries_per_frame
+            out.extend([_to_PIL(_read(entry), True), _to_PIL(_read(entry + 1), True)])
+    return out
+
+
+def load_packed_images(pack_path, idx, modality, short_side=None, as_array=False):
+    """
+    Same as `load_image` but from a packed frame file, with one open and one positional read
+    per needed image.
+    """
+    fd = os.open(pack_path, os.O_RDONLY)
+    try:
+        return _load_packed(lambda size, offset: os.pread(fd, size, offset), idx, modality, short_side, pack_path,
+                            as_array)
+    finally:
+        os.close(fd)
+
+
+def load_packed_buffer(buf, idx, modality, short_side=None, as_array=False):
+    """Same as `load_packed_images` from the bytes of a packed frame file."""
+    buf = memoryview(buf)
+    return _load_packed(lambda size, offset: buf[offset:offset + size].tobytes(), idx, modality, short_side,
+                        as_array=as_array)
+
+
+def compute_log_spectrogram(samples, resampling_rate, window_size=10, step_size=5, eps=1e-6):
+    import librosa
+    # log sepcgram
+    nperseg = int(round(window_size * resampling_rate / 1e3))
+    noverlap = int(round(step_size * resampling_rate / 1e3))
+    spec = librosa.stft(samples, n_fft=511, window='hann', hop_length=noverlap,
+                        win_length=nperseg, pad_mode='constant')
+    spec = np.log(np.real(spec * np.conj(spec)) + eps)
+    return spec
+
+
+def read_audio_window(audio_fname, left_sec, audio_length, resampling_rate):
+    """
+    Read only the samples of the window starting at `left_sec` (clamped into the file) by seeking,
+    the file is expected to be at `resampling_rate` as in `load_sound`.
+    """
+    with soundfile.SoundFile(audio_fname) as f:
+        required_samples = int(round(resampling_rate * audio_length))
+        left_sample = int(round(left_sec * resampling_rate))
+        left_sample = max(0, min(left_sample, f.frames - required_samples))
+        f.seek(left_sample)
+        samples = f.read(required_samples, dtype='float32', always_2d=True)
+    return samples.mean(axis=1)
+
+
+def save_spectrogram_index(data_file, paths, offsets, num_columns, num_bins, hop_length, sample_rate):
+    """
+    Write the index of a spectrogram store next to it (`data_file` + '.npz'), the spectrogram of
+    audio i is the (num_bins x num_columns[i]) float32 array starting at element offsets[i] of `data_file`.
+    """
+    with open(data_file + '.npz', 'wb') as f:
+        np.savez(f, paths=np.asarray([p.encode('utf-8') for p in paths], dtype=np.bytes_),
+                 offsets=np.asarray(offsets, dtype=np.int64), num_columns=np.asarray(num_columns, dtype=np.int64),
+                 num_bins=np.int64(num_bins), hop_length=np.int64(hop_length), sample_rate=np.int64(sample_rate))
+
+
+class SpectrogramStore(object):
+    """
+    Log-spectrograms of whole audio files in one memory-mapped float32 file, created by
+    `build_spec_store.py`. Column j of a video is at time j * hop_length / sample_rate.
+    """
+
+    def __init__(self, data_file):
+        index = np.load(data_file + '.npz')
+        self.data_file = data_file
+        self.paths = {p.decode('utf-8'): i for i, p in enumerate(index['paths'])}
+        self.offsets = index['offsets']
+        self.num_columns = index['num_columns']
+        self.num_bins = int(index['num_bins'])
+        self.hop_length = int(index['hop_length'])
+        self.sample_rate = int(index['sample_rate'])
+        self.data = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
+
+    def __contains__(self, path):
+        return path in self.paths
+
+    def get(self, path, left_sec, audio_length):
+        """(num_bins x columns of audio_length) slice starting at `left_sec` (clamped), or None."""
+        i = self.paths.get(path, None)
+        if i is None:
+            return None
+        if self.data is None:
+            self.data = np.memmap(self.data_file, dtype=np.float32, mode='r')
+        num_columns = int(self.num_columns[i])
+        required_columns = int(round(audio_length * self.sample_rate / self.hop_length)) + 1
+        spec = self.data[self.offsets[i]:self.offsets[i] + self.num_bins * num_columns].reshape(self.num_bins, num_columns)
+        left = int(round(left_sec * self.sample_rate / self.hop_length))
+        left = max(0, min(left, num_columns - required_columns))
+        spec = spec[:, left:left + required_columns]
+        if spec.shape[1] < required_columns:
+            # the audio is shorter than the window, repeat it
+            spec = np.tile(spec, (1, required_columns // max(spec.shape[1], 1) + 1))[:, :required_columns]
+        return np.array(spec)
+
+
 def load_sound(data_dir, record, idx, fps, audio_length, resampling_rate,
-               window_size=10, step_size=5, eps=1e-6):
+               window_size=10, step_size=5, eps=1e-6, spec_store=None):
     import librosa
     """idx must be the center frame of a clip"""
     centre_sec = (record.start_frame + idx) / fps
     left_sec = centre_sec - (audio_length / 2.0)
     right_sec = centre_sec + (audio_length / 2.0)
+    if spec_store is not None and record.path in spec_store:
+        return [Image.fromarray(spec_store.get(record.path, left_sec, audio_length))]
     audio_fname = os.path.join(data_dir, record.path)
     # TODO: generate 0s if the audio file does not exist.
     if not os.path.exists(audio_fname):
         return [Image.fromarray(np.zeros((256, 256 * int(audio_length / 1.28))))]
-    samples, sr = librosa.core.load(audio_fname, sr=None, mono=True)
-    duration = samples.shape[0] / float(resampling_rate)
-
-    left_sample = int(round(left_sec * resampling_rate))
-    right_sample = int(round(right_sec * resampling_rate))
 
     required_samples = int(round(resampling_rate * audio_length))
-
-    if left_sec < 0:
-        samples = samples[:required_samples]
-    elif right_sec > duration:
-        samples = samples[-required_samples:]
-    else:
-        samples = samples[left_sample:right_sample]
+    samples = None
+    if _HAS_SOUNDFILE:
+        # only the window is read, the clamping at both ends is the same as below
+        try:
+            samples = read_audio_window(audio_fname, left_sec, audio_length, resampling_rate)
+        except RuntimeError:
+            # formats libsndfile cannot read (e.g. AAC/M4A) are loaded by librosa through audioread
+            samples = None
+    if samples is None:
+        samples, sr = librosa.core.load(audio_fname, sr=None, mono=True)
+        duration = samples.shape[0] / float(resampling_rate)
+
+        left_sample = int(round(left_sec * resampling_rate))
+        right_sample = int(round(right_sec * resampling_rate))
+
+        if left_sec < 0:
+            samples = samples[:required_samples]
+        elif right_sec > duration:
+            samples = samples[-required_samples:]
+        else:
+            samples = samples[left_sample:right_sample]
 
     # TODO: is the size of spec is fixed if number of samples are different?
     # if the samples is not long enough, repeat the waveform
@@ -146,25 +379,17 @@ def load_sound(data_dir, record, idx, fps, audio_length, resampling_rate,
         samples = np.tile(samples, int(multiplies + 0.5) + 1)
         samples = samples[:required_samples]
 
-    # log sepcgram
-    nperseg = int(round(window_size * resampling_rate / 1e3))
-    noverlap = int(round(step_size * resampling_rate / 1e3))
-    spec = librosa.stft(samples, n_fft=511, window='hann', hop_length=noverlap,
-                        win_length=nperseg, pad_mode='constant')
-    spec = np.log(np.real(spec * np.conj(spec)) + eps)
+    spec = compute_log_spectrogram(samples, resampling_rate, window_size, step_size, eps)
     img = Image.fromarray(spec)
     return [img]
 
 
-def load_data_lmdb(videos, idx, modality):
+def load_data_lmdb(videos, idx, modality, short_side=None, as_array=False):
     def _convert_buffer_to_PIL(tmp_buf, is_flow=False):
         data = six.BytesIO()
         data.write(tmp_buf)
         data.seek(0)
-        img_tmp = Image.open(data).convert('RGB' if not is_flow else 'L')
-        img_ = img_tmp.copy()
-        img_tmp.close()
-        return img_
+        return open_image(data, short_side, 'RGB' if not is_flow else 'L')
 
     img = []
     if modality == 'rgb':
@@ -180,17 +405,85 @@ def load_data_lmdb(videos, idx, modality):
             flow_y = _convert_buffer_to_PIL(x[1], True)
             img.extend([flow_x, flow_y])
     elif modality == 'rgbdiff':
-        tmp = {}
         new_idx = np.unique(np.concatenate((np.asarray(idx), np.asarray(idx) + 1)))
-        for i in new_idx:
-            tmp[i] = _convert_buffer_to_PIL(videos[i])
-        for k in idx:
-            img_ = compute_img_diff(tmp[k + 1], tmp[k])
-            img.append(img_)
-        del tmp
+        frames = np.stack([np.asarray(_convert_buffer_to_PIL(videos[i])) for i in new_idx])
+        img = compute_clip_diff(frames, new_idx, idx)
+        if not as_array:
+            img = [Image.fromarray(x) for x in img]
     return img
 
 
+# Per-frame LMDB layout, every value is read on its own:
+#   __format__            LMDB_FORMAT
+#   __len__, __keys__     number of videos and the list of video keys (json)
+#   <key>/__meta__        {"num_frames": N, "label": label} (json)
+#   <key>/<i>             encoded image i (1-based), flow stores x, y of frame j as 2j-1, 2j
+LMDB_FORMAT = b'frames-v1'
+
+
+def lmdb_frame_key(key, idx):
+    return u'{}/{}'.format(key, idx).encode('utf-8')
+
+
+def write_lmdb_video(txn, key, frames, label, num_frames=None):
+    """
+    Put one video in the per-frame layout.
+
+    Args:
+        txn: lmdb write transaction
+        key (str): video key
+        frames (list[bytes]): encoded images in the order they are addressed (1-based)
+        label: label of the video
+        num_frames (int): number of frames, differs from len(frames) for flow
+    """
+    num_frames = len(frames) if num_frames is None else num_frames
+    for i, frame in enumerate(frames, 1):
+        txn.put(lmdb_frame_key(key, i), frame)
+    txn.put(lmdb_frame_key(key, '__meta__'), json.dumps({'num_frames': num_frames, 'label': label}).encode('utf-8'))
+
+
+def write_lmdb_header(txn, keys):
+    txn.put(b'__format__', LMDB_FORMAT)
+    txn.put(b'__len__', json.dumps(len(keys)).encode('utf-8'))
+    txn.put(b'__keys__', json.dumps(keys).encode('utf-8'))
+
+
+class LMDBVideo(object):
+    """
+    A video in the per-frame layout, indexed like the old unpacked list: [0] is the number of frames,
+    [-1] the label and [i] the buffer of image i. Only the accessed images are read, as memoryviews
+    into the map which stay valid until `close`.
+    """
+
+    def __init__(self, db, key, txn=None):
+        self.key = key.decode('utf-8') if isinstance(key, bytes) else key
+        # a transaction passed in (shared by a batch) is not closed here
+        self.own_txn = txn is None
+        self.txn = db.begin(write=False, buffers=True) if txn is None else txn
+        meta = self.txn.get(lmdb_frame_key(self.key, '__meta__'))
+        if meta is None:
+            self.close()
+            raise KeyError("{} is not in the database".format(self.key))
+        meta = json.loads(bytes(meta).decode('utf-8'))
+        self.num_frames = meta['num_frames']
+        self.label = meta['label']
+
+    def __getitem__(self, idx):
+        if idx == 0:
+            return self.num_frames
+        if idx == -1:
+            return self.label
+        buf = self.txn.get(lmdb_frame_key(self.key, int(idx)))
+        if buf is None:
+            raise IndexError("{} has no image {}".format(self.key, idx))
+        return buf
+
+    def close(self):
+        if self.txn is not None and self.own_txn:
+            self.txn.abort()
+        self.txn = None
+
+
 def sample_train_clip(video_length, num_consecutive_frames, num_frames, sample_freq, dense_sampling, num_clips=1):
     max_frame_idx = max(1, video_length - num_consecutive_frames + 1)
     if dense_sampling:
@@ -326,6 +619,250 @@ def sample_val_test_clip(video_length, num_consecutive_frames, num_frames, sampl
     return frame_idx
 
 
+class SharedFrameCache(object):
+    """
+    Decoded frames keyed by (video path, frame index), shared by all DataLoader workers. The frames
+    live in fixed-size slots of shared memory, grouped into buckets of `ways` slots: a key is only
+    looked up in the bucket of its hash and the least recently used slot of the bucket is evicted first.
+    The buckets are guarded by `num_locks` striped locks, so the workers hitting different buckets do
+    not wait for each other. Create it in the main process before the workers are started.
+    """
+
+    def __init__(self, budget_bytes, slot_bytes=512 * 1024, ways=8, num_locks=64):
+        self.slot_bytes = int(slot_bytes)
+        self.ways = ways
+        self.num_buckets = max(1, int(budget_bytes // self.slot_bytes) // ways)
+        self.num_slots = self.num_buckets * ways
+        self._data = multiprocessing.RawArray(ctypes.c_uint8, self.num_slots * self.slot_bytes)
+        self._keys = multiprocessing.RawArray(ctypes.c_int64, self.num_slots)
+        self._shapes = multiprocessing.RawArray(ctypes.c_int32, self.num_slots * 3)
+        self._ticks = multiprocessing.RawArray(ctypes.c_int64, self.num_slots)
+        self._locks = [multiprocessing.Lock() for _ in range(min(num_locks, self.num_buckets))]
+        # clock, hits, misses of every lock, only updated under it
+        self._counters = multiprocessing.RawArray(ctypes.c_int64, len(self._locks) * 3)
+        self._arrays = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def _get_arrays(self):
+        if self._arrays is None:
+            self._arrays = (np.frombuffer(self._data, dtype=np.uint8).reshape(self.num_slots, self.slot_bytes),
+                            np.frombuffer(self._keys, dtype=np.int64),
+                            np.frombuffer(self._shapes, dtype=np.int32).reshape(self.num_slots, 3),
+                            np.frombuffer(self._ticks, dtype=np.int64),
+                            np.frombuffer(self._counters, dtype=np.int64).reshape(len(self._locks), 3))
+        return self._arrays
+
+    @staticmethod
+    def _key(path, idx):
+        digest = hashlib.blake2b(u'{}/{}'.format(path, int(idx)).encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'little', signed=True) or 1  # 0 marks an empty slot
+
+    def _bucket(self, key):
+        """First slot of the bucket of `key` and the index of its lock."""
+        bucket = key % self.num_buckets
+        return bucket * self.ways, bucket % len(self._locks)
+
+    def get(self, path, idx):
+        """Returns a copy of the cached (H x W x C) uint8 frame, or None."""
+        key = self._key(path, idx)
+        first, lock_id = self._bucket(key)
+        data, keys, shapes, ticks, counters = self._get_arrays()
+        counters = counters[lock_id]
+        with self._locks[lock_id]:
+            slots = np.flatnonzero(keys[first:first + self.ways] == key)
+            if len(slots) == 0:
+                counters[2] += 1
+                return None
+            slot = first + slots[0]
+            counters[0] += 1
+            counters[1] += 1
+            ticks[slot] = counters[0]
+            shape = tuple(shapes[slot])
+            return data[slot, :int(np.prod(shape))].reshape(shape).copy()
+
+    def put(self, path, idx, frame):
+        """Caches an (H x W x C) uint8 frame, frames larger than a slot are not cached."""
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        if frame.ndim != 3 or frame.nbytes > self.slot_bytes:
+            return
+        key = self._key(path, idx)
+        first, lock_id = self._bucket(key)
+        data, keys, shapes, ticks, counters = self._get_arrays()
+        counters = counters[lock_id]
+        with self._locks[lock_id]:
+            if np.any(keys[first:first + self.ways] == key):
+                return
+            slot = first + np.argmin(ticks[first:first + self.ways])  # empty slots have never been used
+            # the slot is emptied first, an interrupted write (e.g. `LatencyGuardDataSet`) leaves no stale key
+            keys[slot] = 0
+            data[slot, :frame.nbytes] = frame.reshape(-1)
+            shapes[slot] = frame.shape
+            keys[slot] = key
+            counters[0] += 1
+            ticks[slot] = counters[0]
+
+    def stats(self):
+        _, keys, _, _, counters = self._get_arrays()
+        hits, misses = int(counters[:, 1].sum()), int(counters[:, 2].sum())
+        return {'hits': hits, 'misses': misses, 'hit_rate': hits / max(hits + misses, 1),
+                'used_slots': int(np.count_nonzero(keys)), 'num_slots': self.num_slots}
+
+
+class PrecollatedBatch(tuple):
+    """(images, labels) of a whole batch built by `__getitems__`, passed through by `batch_collate`."""
+    pass
+
+
+def getitems_into_batch(dataset, indices, sort_key=None):
+    """
+    Load the samples at `indices` (in the order of `sort_key` for locality) straight into one
+    preallocated batch tensor, in shared memory when called in a DataLoader worker.
+    """
+    order = sorted(range(len(indices)), key=lambda k: sort_key(indices[k])) if sort_key is not None \
+        else range(len(indices))
+    images, labels = None, [None] * len(indices)
+    for k in order:
+        sample, label = dataset[indices[k]]
+        if images is None:
+            images = torch.empty((len(indices),) + tuple(sample.shape), dtype=sample.dtype)
+            if data.get_worker_info() is not None:
+                # the batch is sent to the main process without another copy
+                images.share_memory_()
+        images[k] = sample
+        labels[k] = label
+    return PrecollatedBatch((images, data.dataloader.default_collate(labels)))
+
+
+class SampleTimeout(Exception):
+    pass
+
+
+def _raise_sample_timeout(signum, frame):
+    raise SampleTimeout()
+
+
+class LatencyGuardDataSet(data.Dataset):
+    """
+    Gives every sample of `dataset` a time budget, a sample over the budget is abandoned and replaced by
+    a recent sample of the same class (or of another random video), so one slow video does not stall
+    its whole batch. The slow videos are appended to `slow_log` in the quarantine format (see
+    `load_quarantine`), usually the quarantine list of the list file (`default_quarantine_path`), to be
+    skipped later. The budget is enforced with SIGALRM, so only in the main thread of a process (as in
+    DataLoader workers); elsewhere slow samples are only logged. It is a soft limit: the signal is handled
+    between Python bytecodes, a sample blocked in a native call (a decoder, a file read) is only stopped
+    when that call returns.
+    With `batched_getitems`, the batch is read within the `batch_reads` of the wrapped dataset if it has one
+    (e.g. one LMDB read transaction per batch) and every sample still has its own budget.
+    """
+
+    def __init__(self, dataset, budget, slow_log=None, max_cached=32, max_retries=3):
+        self.dataset = dataset
+        self.budget = budget
+        self.slow_log = slow_log
+        self.max_cached = max_cached
+        self.max_retries = max_retries
+        self.batched_getitems = False
+        self.recent = OrderedDict()
+        self.num_substituted = 0
+
+    def __getattr__(self, name):
+        # the other attributes (video_list, remove_data, ...) are the ones of the wrapped dataset
+        if name == 'dataset' or name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    @property
+    def batched_getitems(self):
+        return self._batched_getitems
+
+    @batched_getitems.setter
+    def batched_getitems(self, value):
+        self._batched_getitems = value
+        if hasattr(self.dataset, 'batched_getitems'):
+            self.dataset.batched_getitems = value
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def _path(self, index):
+        if hasattr(self.dataset, 'video_list'):
+            return self.dataset.video_list.path(index)
+        if hasattr(self.dataset, 'keys'):
+            return self.dataset.keys[index].decode('utf-8')
+        return str(index)
+
+    def _label(self, index):
+        return self.dataset.video_list.label(index) if hasattr(self.dataset, 'video_list') else None
+
+    def _log_slow(self, index, elapsed, substituted):
+        self.num_substituted += int(substituted)
+        reason = "slow: {:.1f}s over a budget of {:.1f}s (index {})".format(elapsed, self.budget, index)
+        print("{} {}, {} samples substituted in this worker".format(self._path(index), reason,
+                                                                   self.num_substituted), flush=True)
+        if self.slow_log is not None:
+            with open(self.slow_log, 'a') as f:
+                f.write("{}\tskip\t0\t{}\n".format(self._path(index), reason))
+
+    def _get_in_budget(self, index):
+        in_main_thread = threading.current_thread() is threading.main_thread()
+        start = time.time()
+        if in_main_thread:
+            handler = signal.signal(signal.SIGALRM, _raise_sample_timeout)
+            signal.setitimer(signal.ITIMER_REAL, self.budget)
+        try:
+            sample = self.dataset[index]
+        except SampleTimeout:
+            if hasattr(self.dataset, 'release_buffer'):
+                # the abandoned sample may hold a read transaction
+                self.dataset.release_buffer()
+            self._log_slow(index, time.time() - start, True)
+            return None
+        finally:
+            if in_main_thread:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, handler if handler is not None else signal.SIG_DFL)
+        if time.time() - start > self.budget:
+            self._log_slow(index, time.time() - start, False)
+        return sample
+
+    def __getitem__(self, index):
+        sample = self._get_in_budget(index)
+        label = self._label(index)
+        if sample is not None:
+            if label is not None and not isinstance(label, list):
+                self.recent[label] = sample
+                self.recent.move_to_end(label)
+                if len(self.recent) > self.max_cached:
+                    self.recent.popitem(last=False)
+            return sample
+        if label in self.recent:
+            return self.recent[label]
+        for _ in range(self.max_retries):
+            sample = self._get_in_budget(random.randrange(len(self.dataset)))
+            if sample is not None:
+                return sample
+        # give up on the budget rather than failing the batch
+        return self.dataset[random.randrange(len(self.dataset))]
+
+    def __getitems__(self, indices):
+        if not self.batched_getitems:
+            return [self[i] for i in indices]
+        batch_reads = self.dataset.batch_reads() if hasattr(self.dataset, 'batch_reads') else contextlib.nullcontext()
+        with batch_reads:
+            return getitems_into_batch(self, indices, sort_key=self._path)
+
+
+def augment_views(transform, images, num_views=1):
+    """Transform one decoded clip `num_views` times independently, the views are stacked in dim 0."""
+    if num_views == 1:
+        return transform(images)
+    return torch.stack([transform(images) for _ in range(num_views)])
+
+
 class VideoRecord(object):
     def __init__(self, path, start_frame, end_frame, label, reverse=False):
         self.path = path
@@ -343,13 +880,136 @@ class VideoRecord(object):
         return self.path
 
 
+class VideoList(object):
+    """
+    The parsed list file as flat arrays (paths packed in one byte buffer, start/end frame columns
+    and ragged labels), `VideoRecord`s are created on access. Unlike a list of objects, the arrays
+    are not touched by refcounting, so the pages stay shared with the forked DataLoader workers.
+    """
+
+    def __init__(self, paths, start_frames, end_frames, labels, multi_label=False):
+        paths = [p.encode('utf-8') for p in paths]
+        self.path_offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+        self.path_offsets[1:] = np.cumsum([len(p) for p in paths])
+        self.path_buffer = np.frombuffer(b''.join(paths), dtype=np.uint8)
+        self.start_frames = np.asarray(start_frames, dtype=np.int64)
+        self.end_frames = np.asarray(end_frames, dtype=np.int64)
+        self.label_offsets = np.zeros(len(labels) + 1, dtype=np.int64)
+        self.label_offsets[1:] = np.cumsum([len(l) for l in labels])
+        self.label_values = np.asarray([x for l in labels for x in l], dtype=np.float64)
+        self.multi_label = multi_label
+
+    def __len__(self):
+        return len(self.start_frames)
+
+    def path(self, i):
+        return self.path_buffer[self.path_offsets[i]:self.path_offsets[i + 1]].tobytes().decode('utf-8')
+
+    def label(self, i):
+        labels = self.label_values[self.label_offsets[i]:self.label_offsets[i + 1]]
+        if len(labels) == 0:  # test mode
+            return -1
+        if len(labels) == 1 and not self.multi_label:
+            return float(labels[0])
+        return labels.tolist()
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("video index {} is out of range".format(i))
+        return VideoRecord(self.path(i), int(self.start_frames[i]), int(self.end_frames[i]), self.label(i))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def select(self, mask):
+        """Keep the videos where `mask` (bool array) is True, returns a new VideoList."""
+        keep = np.flatnonzero(mask)
+        new = VideoList.__new__(VideoList)
+        path_lengths = np.diff(self.path_offsets)[keep]
+        new.path_offsets = np.zeros(len(keep) + 1, dtype=np.int64)
+        new.path_offsets[1:] = np.cumsum(path_lengths)
+        new.path_buffer = self.path_buffer[_ranges_to_index(self.path_offsets[keep], path_lengths)]
+        new.start_frames = self.start_frames[keep]
+        new.end_frames = self.end_frames[keep]
+        label_lengths = np.diff(self.label_offsets)[keep]
+        new.label_offsets = np.zeros(len(keep) + 1, dtype=np.int64)
+        new.label_offsets[1:] = np.cumsum(label_lengths)
+        new.label_values = self.label_values[_ranges_to_index(self.label_offsets[keep], label_lengths)]
+        new.multi_label = self.multi_label
+        return new
+
+
+def _ranges_to_index(starts, lengths):
+    # concatenation of np.arange(s, s + l) for all (s, l), without a python loop
+    nonempty = lengths > 0
+    starts, lengths = starts[nonempty], lengths[nonempty]
+    if len(lengths) == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.cumsum(lengths)
+    steps = np.ones(ends[-1], dtype=np.int64)
+    steps[0] = starts[0]
+    # the first element of each range jumps from the last element of the previous range
+    steps[ends[:-1]] = starts[1:] - (starts[:-1] + lengths[:-1] - 1)
+    return np.cumsum(steps)
+
+
+def default_quarantine_path(list_file):
+    return os.path.splitext(list_file)[0] + '.quarantine'
+
+
+def save_quarantine(quarantine_file, entries):
+    """
+    Write the quarantine list of a list file (see `scan_dataset.py`), one tab-separated line per video
+    with path, action ('skip' or 'remap'), true number of frames and the reason.
+    """
+    with open(quarantine_file, 'w') as f:
+        for path, action, true_frames, reason in entries:
+            f.write("{}\t{}\t{}\t{}\n".format(path, action, int(true_frames), reason.replace('\n', ' ')))
+
+
+def load_quarantine(quarantine_file):
+    """Returns {path: (action, true_frames, reason)} of a quarantine list."""
+    quarantine = {}
+    for x in open(quarantine_file):
+        elements = x.rstrip('\n').split('\t')
+        if len(elements) < 3:
+            continue
+        if elements[1] not in ['skip', 'remap']:
+            raise ValueError("unknown quarantine action {} of {}".format(elements[1], elements[0]))
+        quarantine[elements[0]] = (elements[1], int(elements[2]), elements[3] if len(elements) > 3 else '')
+    return quarantine
+
+
+def order_frames(images, frame_order, num_segments):
+    """
+    Reverse or shuffle the `num_segments` segments of a clip, the consecutive images of a segment
+    (e.g. flow x/y) keep their order. `images` is a list or an array of the frames.
+    """
+    if frame_order == 'normal' or num_segments <= 1:
+        return images
+    if frame_order == 'reverse':
+        order = np.arange(num_segments)[::-1]
+    elif frame_order == 'random':
+        order = np.random.permutation(num_segments)
+    else:
+        raise ValueError("frame_order should be 'normal', 'reverse' or 'random'.")
+    group = len(images) // num_segments
+    idx = (order[:, None] * group + np.arange(group)).reshape(-1)
+    return images[idx] if isinstance(images, np.ndarray) else [images[i] for i in idx]
+
+
 class VideoDataSet(data.Dataset):
 
     def __init__(self, root_path, list_file, num_groups=64, frames_per_group=1, sample_offset=0, num_clips=1,
                  modality='rgb', dense_sampling=False, fixed_offset=True,
                  image_tmpl='{:05d}.jpg', transform=None, is_train=True, test_mode=False, seperator=' ',
                  filter_video=0, num_classes=None, whole_video=False,
-                 fps=29.97, audio_length=1.28, resampling_rate=24000):
+                 fps=29.97, audio_length=1.28, resampling_rate=24000, num_views=1, frame_cache=None,
+                 packed=False, decode_short_side=None, clip_format='pil', spec_store=None, quarantine=None,
+                 frame_order='normal'):
         """
 
         Arguments have different meaning when dense_sampling is True:
@@ -374,6 +1034,19 @@ class VideoDataSet(data.Dataset):
             fps (float): frame rate per second, used to localize sound when frame idx is selected.
             audio_length (float): the time window to extract audio feature.
             resampling_rate (int): used to resampling audio extracted from wav
+            num_views (int): number of independently augmented views of the decoded clip,
+                             stacked in dim 0 when it is larger than 1 (see `multi_view_collate`)
+            frame_cache (SharedFrameCache): cache of the decoded rgb frames shared by the workers
+            packed (bool): read the frames of a video from <folder_path>.pack (see `pack_frames.py`)
+                           instead of one file per frame
+            decode_short_side (int): decode the frames at this shorter side, usually the scale size
+                                     of the augmentor (see `get_decode_short_side`)
+            clip_format (str): 'array' returns rgbdiff frames as one (T x H x W x C) uint8 array for
+                               the array backend of `get_augmentor`, otherwise PIL images
+            spec_store (str): precomputed log-spectrograms of the sound modality (see `build_spec_store.py`)
+            quarantine (str): quarantine list of the list file (see `scan_dataset.py`), the videos marked
+                              'skip' are removed and the frame range of the ones marked 'remap' is corrected
+            frame_order (str): normal, reverse or random order of the segments of the returned clip
         """
         if modality not in ['flow', 'rgb', 'rgbdiff', 'sound']:
             raise ValueError("modality should be 'flow' or 'rgb' or 'rgbdiff' or 'sound'.")
@@ -407,7 +1080,17 @@ class VideoDataSet(data.Dataset):
             self.num_consecutive_frames = 1
 
         self.video_list, self.multi_label = self._parse_list()
+        if quarantine is not None:
+            self._apply_quarantine(quarantine)
         self.num_classes = num_classes
+        self.num_views = num_views
+        self.frame_cache = frame_cache
+        self.batched_getitems = False
+        self.packed = packed
+        self.decode_short_side = decode_short_side
+        self.clip_format = clip_format
+        self.spec_store = SpectrogramStore(spec_store) if spec_store is not None else None
+        self.frame_order = frame_order
 
     def _parse_list(self):
         # usually it is [video_id, num_frames, class_idx]
@@ -435,32 +1118,46 @@ class VideoDataSet(data.Dataset):
        
         # TODO: a better way to check if multi-label or not
         multi_label = np.mean(np.asarray([len(x) for x in tmp])) > 4.0
-        file_list = []
-        for item in tmp:
-            if self.test_mode:
-                file_list.append([item[0], int(item[1]), int(item[2]), -1])
-            else:
-                labels = []
-                for i in range(3, len(item)):
-                    labels.append(float(item[i]))
-                if not multi_label:
-                    labels = labels[0] if len(labels) == 1 else labels
-                file_list.append([item[0], int(item[1]), int(item[2]), labels])
-
-        video_list = [VideoRecord(item[0], item[1], item[2], item[3]) for item in file_list]
+        paths = [item[0] for item in tmp]
+        start_frames = [int(item[1]) for item in tmp]
+        end_frames = [int(item[2]) for item in tmp]
+        labels = [[] if self.test_mode else [float(x) for x in item[3:]] for item in tmp]
+        del tmp
+
+        video_list = VideoList(paths, start_frames, end_frames, labels, multi_label)
         # flow model has one frame less
         if self.modality in ['rgbdiff']:
-            for i in range(len(video_list)):
-                video_list[i].end_frame -= 1
+            video_list.end_frames -= 1
 
         #if self.is_train:
         #    video_list = video_list[:50000]
 
         return video_list, multi_label
 
+    def _apply_quarantine(self, quarantine_file):
+        quarantine = load_quarantine(quarantine_file)
+        skipped, remapped = [], 0
+        for i in range(len(self.video_list)):
+            entry = quarantine.get(self.video_list.path(i), None)
+            if entry is None:
+                continue
+            action, true_frames, _ = entry
+            if action == 'skip' or true_frames <= 0:
+                skipped.append(i)
+            else:
+                end_frame = self.video_list.start_frames[i] + true_frames - 1
+                # flow model has one frame less
+                self.video_list.end_frames[i] = end_frame - 1 if self.modality in ['rgbdiff'] else end_frame
+                remapped += 1
+        print("Quarantine {}: remap {} videos".format(quarantine_file, remapped))
+        if len(skipped) > 0:
+            self.remove_data(skipped)
+
     def remove_data(self, idx):
         original_video_num = len(self.video_list)
-        self.video_list = [v for i, v in enumerate(self.video_list) if i not in idx]
+        mask = np.ones(original_video_num, dtype=bool)
+        mask[np.asarray(list(idx), dtype=np.int64)] = False
+        self.video_list = self.video_list.select(mask)
         print("Original videos: {}\t remove {} videos, remaining {} videos".format(original_video_num, len(idx), len(self.video_list)))
 
     def _sample_indices(self, record):
@@ -483,12 +1180,18 @@ class VideoDataSet(data.Dataset):
         # check this is a legit video folder
         indices = self._sample_indices(record) if self.is_train else self._get_val_indices(record)
         images = self.get_data(record, indices)
-        images = self.transform(images)
+        images = augment_views(self.transform, images, self.num_views)
         label = self.get_label(record)
 
         # re-order data to targeted format.
         return images, label
 
+    def __getitems__(self, indices):
+        if not self.batched_getitems:
+            return [self[i] for i in indices]
+        # group the reads of the same directory/video file
+        return getitems_into_batch(self, indices, sort_key=self.video_list.path)
+
     def get_data(self, record, indices):
         images = []
         if self.whole_video:
@@ -507,16 +1210,62 @@ class VideoDataSet(data.Dataset):
                     if self.num_frames % 2 == 0 else curr_indiecs[self.num_frames // 2]
                 center_idx = min(record.num_frames, center_idx)
                 seg_imgs = load_sound(self.root_path, record, center_idx,
-                                      self.fps, self.audio_length, self.resampling_rate)
+                                      self.fps, self.audio_length, self.resampling_rate,
+                                      spec_store=self.spec_store)
                 images.extend(seg_imgs)
+        elif self.packed:
+            images = self._get_packed_data(record, indices)
+        elif self.modality == 'rgbdiff':
+            # the frames of all segments are loaded once and differenced together
+            new_seg_ind = [min(seg_ind + record.start_frame - 1 + i, record.num_frames)
+                           for seg_ind in indices for i in range(self.num_consecutive_frames)]
+            images = load_image(record.path, self.image_tmpl, new_seg_ind, self.modality,
+                                self.decode_short_side, as_array=self.clip_format == 'array')
         else:
             images = []
+            use_cache = self.frame_cache is not None and self.modality == 'rgb'
             for seg_ind in indices:
                 new_seg_ind = [min(seg_ind + record.start_frame - 1 + i, record.num_frames)
                                for i in range(self.num_consecutive_frames)]
+                frame = self.frame_cache.get(record.path, new_seg_ind[0]) if use_cache else None
+                if frame is not None:
+                    images.append(Image.fromarray(frame))
+                    continue
                 seg_imgs = load_image(record.path, self.image_tmpl,
-                                      new_seg_ind, self.modality)
+                                      new_seg_ind, self.modality, self.decode_short_side)
+                if use_cache:
+                    self.frame_cache.put(record.path, new_seg_ind[0], np.asarray(seg_imgs[0]))
                 images.extend(seg_imgs)
+        if self.modality != 'sound':
+            images = order_frames(images, self.frame_order, len(indices))
+        return images
+
+    def _get_packed_data(self, record, indices):
+        # resolved like the frame folders of `pack_frames.py`, absolute paths in the list file are kept
+        pack_path = os.path.join(self.root_path, record.path).rstrip('/') + PACK_SUFFIX
+        seg_inds = [[min(seg_ind + record.start_frame - 1 + i, record.num_frames)
+                     for i in range(self.num_consecutive_frames)] for seg_ind in indices]
+        if self.modality == 'rgbdiff':
+            # the frames of all segments are differenced together, they are not cached
+            return load_packed_images(pack_path, [i for x in seg_inds for i in x], self.modality,
+                                      self.decode_short_side, as_array=self.clip_format == 'array')
+        use_cache = self.frame_cache is not None and self.modality == 'rgb'
+        cached = [self.frame_cache.get(record.path, x[0]) if use_cache else None for x in seg_inds]
+        missing = [x for x, frame in zip(seg_inds, cached) if frame is None]
+        # all missing frames of the video with a single open
+        loaded = load_packed_images(pack_path, [i for x in missing for i in x], self.modality,
+                                    self.decode_short_side) if len(missing) > 0 else []
+        images_per_seg = self.num_consecutive_frames * (2 if self.modality == 'flow' else 1)
+        images, pos = [], 0
+        for x, frame in zip(seg_inds, cached):
+            if frame is not None:
+                images.append(Image.fromarray(frame))
+                continue
+            seg_imgs = loaded[pos:pos + images_per_seg]
+            pos += images_per_seg
+            if use_cache:
+                self.frame_cache.put(record.path, x[0], np.asarray(seg_imgs[0]))
+            images.extend(seg_imgs)
         return images
 
     def get_label(self, record):
@@ -543,7 +1292,9 @@ class VideoDataSetLMDB(data.Dataset):
                  modality='rgb', dense_sampling=False, fixed_offset=True,
                  image_tmpl='{:05d}.jpg', transform=None, is_train=True, test_mode=False,
                  seperator=' ', filter_video=0, num_classes=None, whole_video=False,
-                 fps=29.97, audio_length=1.28, resampling_rate=24000):
+                 fps=29.97, audio_length=1.28, resampling_rate=24000, num_views=1,
+                 frame_cache=None, decode_short_side=None, clip_format='pil', quarantine=None,
+                 frame_order='normal'):
         """
 
         Arguments have different meaning when dense_sampling is True:
@@ -563,6 +1314,9 @@ class VideoDataSetLMDB(data.Dataset):
             transform: the transformer for preprocessing
             is_train (bool): shuffle the video but keep the causality
             test_mode (bool): testing mode, no label
+            quarantine (str): quarantine list (see `scan_dataset.py`), the videos marked 'skip' are removed,
+                              the frame counts are stored in the database so 'remap' does not apply
+            frame_order (str): normal, reverse or random order of the segments of the returned clip
         """
         # TODO: handle multi-label?
         # TODO: flow data?
@@ -607,8 +1361,15 @@ class VideoDataSetLMDB(data.Dataset):
         db = lmdb.open(self.db_path, max_readers=1, subdir=os.path.isdir(self.db_path),
                        readonly=True, lock=False, readahead=False, meminit=False)
         with db.begin(write=False) as txn:
-            self.length = pa.deserialize(txn.get(b'__len__'))
-            self.keys = pa.deserialize(txn.get(b'__keys__'))
+            self.per_frame = txn.get(b'__format__') == LMDB_FORMAT
+            if self.per_frame:
+                self.length = json.loads(txn.get(b'__len__').decode('utf-8'))
+                self.keys = [k.encode('utf-8') for k in json.loads(txn.get(b'__keys__').decode('utf-8'))]
+            else:
+                if not _HAS_PYARROW:
+                    raise ValueError("{} is in the pyarrow-serialized format: {}".format(self.db_path, _PYARROW_ERROR_MSG))
+                self.length = pa.deserialize(txn.get(b'__len__'))
+                self.keys = pa.deserialize(txn.get(b'__keys__'))
         db.close()
 
         # TODO: a hack way to filter video
@@ -644,12 +1405,28 @@ class VideoDataSetLMDB(data.Dataset):
         if self.length != len(self.keys):
             raise ValueError("Do not filter video correctly.")
 
+        if quarantine is not None:
+            skipped = set([os.path.basename(path).encode('utf-8')
+                           for path, (action, true_frames, _) in load_quarantine(quarantine).items()
+                           if action == 'skip' or true_frames <= 0])
+            self.keys = [k for k in self.keys if k not in skipped]
+            print("Quarantine {}: skip {} videos".format(quarantine, self.length - len(self.keys)))
+            self.length = len(self.keys)
+
         self.num_classes = num_classes
+        self.num_views = num_views
+        self.frame_cache = frame_cache
+        self.batched_getitems = False
+        self.batch_txn = None
+        self.decode_short_side = decode_short_side
+        self.clip_format = clip_format
+        self.frame_order = frame_order
         self.unpacked_video = None
 
     def remove_data(self, idx):
         original_video_num = self.length
-        self.keys = [v for i, v in enumerate(self.keys) if i not in idx]
+        removed = set(idx)
+        self.keys = [v for i, v in enumerate(self.keys) if i not in removed]
         self.length -= len(idx)
         print("Original videos: {}\t remove {} videos, remaining {} videos".format(original_video_num, len(idx), self.length))
 
@@ -668,17 +1445,49 @@ class VideoDataSetLMDB(data.Dataset):
         record = VideoRecord(self.keys[index].decode("utf-8"), 1, num_frames, unpacked_video[-1])
         indices = self._sample_indices(record) if self.is_train else self._get_val_indices(record)
         images = self.get_data(record, indices, unpacked_video)
-        images = self.transform(images)
+        self.release_buffer()
+        images = order_frames(images, self.frame_order, len(indices))
+        images = augment_views(self.transform, images, self.num_views)
         label = self.get_label(record)
-        self.unpacked_video = None
         # re-order data to targeted format.
         return images, label
 
-    def maybe_open_and_get_buffer(self, index):
+    def __getitems__(self, indices):
+        if not self.batched_getitems:
+            return [self[i] for i in indices]
+        with self.batch_reads():
+            return getitems_into_batch(self, indices, sort_key=lambda i: self.keys[i])
+
+    @contextlib.contextmanager
+    def batch_reads(self):
+        """One read transaction for the samples read within it, keys are read in their b-tree order."""
+        self.maybe_open_db()
+        if self.per_frame:
+            self.batch_txn = self.db.begin(write=False, buffers=True)
+        try:
+            yield
+        finally:
+            if self.batch_txn is not None:
+                self.batch_txn.abort()
+                self.batch_txn = None
+
+    def maybe_open_db(self):
         if self.db is None:
             self.db = lmdb.open(self.db_path, max_readers=1, subdir=os.path.isdir(self.db_path),
                                 readonly=True, lock=False, readahead=False, meminit=False)
 
+    def maybe_open_and_get_buffer(self, index):
+        self.maybe_open_db()
+
+        if self.per_frame:
+            try:
+                unpacked_video = LMDBVideo(self.db, self.keys[index], self.batch_txn)
+            except Exception as e:
+                unpacked_video = LMDBVideo(self.db, self.keys[0], self.batch_txn)
+                print(self.keys[index], e, flush=True)
+            self.unpacked_video = unpacked_video
+            return unpacked_video
+
         with self.db.begin(write=False) as txn:
             byteflow = txn.get(self.keys[index])
         try:
@@ -692,12 +1501,29 @@ class VideoDataSetLMDB(data.Dataset):
         self.unpacked_video = unpacked_video
         return unpacked_video
 
+    def release_buffer(self):
+        if isinstance(self.unpacked_video, LMDBVideo):
+            self.unpacked_video.close()
+        self.unpacked_video = None
+
     def get_data(self, record, indices, unpacked_video):
+        if self.modality == 'rgbdiff':
+            new_seg_ind = [min(seg_ind + record.start_frame - 1 + i, record.num_frames)
+                           for seg_ind in indices for i in range(self.num_consecutive_frames)]
+            return load_data_lmdb(unpacked_video, new_seg_ind, self.modality, self.decode_short_side,
+                                  as_array=self.clip_format == 'array')
         images = []
+        use_cache = self.frame_cache is not None and self.modality == 'rgb'
         for seg_ind in indices:
             new_seg_ind = [min(seg_ind + record.start_frame - 1 + i, record.num_frames)
                            for i in range(self.num_consecutive_frames)]
-            img = load_data_lmdb(unpacked_video, new_seg_ind, self.modality)
+            frame = self.frame_cache.get(record.path, new_seg_ind[0]) if use_cache else None
+            if frame is not None:
+                images.append(Image.fromarray(frame))
+                continue
+            img = load_data_lmdb(unpacked_video, new_seg_ind, self.modality, self.decode_short_side)
+            if use_cache:
+                self.frame_cache.put(record.path, new_seg_ind[0], np.asarray(img[0]))
             images.extend(img)
         return images
 
@@ -917,7 +1743,7 @@ class MultiVideoDataSetLMDB(data.Dataset):
                 record = VideoRecord(video_dataset.keys[index].decode("utf-8"), 1, num_frames, unpacked_video[-1])
 
                 images = video_dataset.get_data(record, indices, video_dataset.unpacked_video)
-                video_dataset.unpacked_video = None
+                video_dataset.release_buffer()
 
             images = video_dataset.transform(images)
             label = video_dataset.get_label(record)
@@ -929,13 +1755,253 @@ class MultiVideoDataSetLMDB(data.Dataset):
         return len(self.video_datasets[0])
 
 
+def default_video_index_path(list_file):
+    return os.path.splitext(list_file)[0] + '.index.npz'
+
+
+def probe_video_index(video_path):
+    """
+    Demux (without decoding) a video once and record its frame layout.
+
+    Args:
+        video_path (str): path to the video file
+
+    Returns:
+        np.ndarray: pts of every frame in presentation order (int64), its length is the true frame count
+        np.ndarray: ordinals (into the pts table) of the keyframes (int32)
+    """
+    container = av.open(video_path)
+    stream = container.streams.video[0]
+    frame_pts = []
+    key_pts = []
+    for packet in container.demux(stream):
+        if packet.size == 0:  # flushing packet
+            continue
+        pts = packet.pts if packet.pts is not None else packet.dts
+        if pts is None:
+            continue
+        frame_pts.append(pts)
+        if packet.is_keyframe:
+            key_pts.append(pts)
+    container.close()
+    frame_pts = np.sort(np.asarray(frame_pts, dtype=np.int64))
+    key_idx = np.unique(np.searchsorted(frame_pts, np.asarray(key_pts, dtype=np.int64))).astype(np.int32)
+    if len(key_idx) == 0 or key_idx[0] != 0:
+        # no keyframe flag at the beginning, seeking to the first frame is always valid
+        key_idx = np.concatenate((np.zeros(1, dtype=np.int32), key_idx))
+    return frame_pts, key_idx
+
+
+def save_video_index(index_file, paths, frame_pts_list, key_idx_list):
+    """
+    Pack the per-video tables into one sidecar file, the tables of video i are
+    frame_pts[frame_offsets[i]:frame_offsets[i + 1]] and key_idx[key_offsets[i]:key_offsets[i + 1]].
+    """
+    frame_offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+    frame_offsets[1:] = np.cumsum([len(x) for x in frame_pts_list])
+    key_offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+    key_offsets[1:] = np.cumsum([len(x) for x in key_idx_list])
+    frame_pts = np.concatenate(frame_pts_list).astype(np.int64) if len(paths) > 0 else np.zeros(0, np.int64)
+    key_idx = np.concatenate(key_idx_list).astype(np.int32) if len(paths) > 0 else np.zeros(0, np.int32)
+    with open(index_file, 'wb') as f:
+        np.savez(f, paths=np.asarray([p.encode('utf-8') for p in paths], dtype=np.bytes_),
+                 frame_offsets=frame_offsets, frame_pts=frame_pts,
+                 key_offsets=key_offsets, key_idx=key_idx)
+
+
+class VideoIndex(object):
+    """Keyframe/PTS sidecar of a list file, created by `build_video_index.py`."""
+
+    def __init__(self, index_file):
+        data = np.load(index_file)
+        self.paths = {p.decode('utf-8'): i for i, p in enumerate(data['paths'])}
+        self.frame_offsets = data['frame_offsets']
+        self.frame_pts = data['frame_pts']
+        self.key_offsets = data['key_offsets']
+        self.key_idx = data['key_idx']
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, path):
+        return path in self.paths
+
+    def get(self, path):
+        """
+        Returns:
+            np.ndarray: pts of every frame, np.ndarray: frame ordinals of keyframes; None if it is not indexed
+        """
+        i = self.paths.get(path, None)
+        if i is None:
+            return None
+        frame_pts = self.frame_pts[self.frame_offsets[i]:self.frame_offsets[i + 1]]
+        key_idx = self.key_idx[self.key_offsets[i]:self.key_offsets[i + 1]]
+        if len(frame_pts) == 0:
+            return None
+        return frame_pts, key_idx
+
+
+def indexed_decoding(container, frame_pts, key_idx, index):
+    """
+    Decode exactly the frames at `index` (frame ordinals), seeking to the keyframe preceding a
+    target only when that keyframe is beyond the last decoded frame, so each needed GOP is
+    decoded once.
+
+    Returns:
+        dict: frame ordinal -> av.VideoFrame, targets which can not be decoded are missing.
+    """
+    stream = container.streams.video[0]
+    targets = np.unique(np.clip(index, 0, len(frame_pts) - 1))
+    gop_start = key_idx[np.maximum(np.searchsorted(key_idx, targets, side='right') - 1, 0)]
+    wanted = set(targets.tolist())
+    frames = {}
+    last = -1
+    i = 0
+    while i < len(targets):
+        if gop_start[i] > last + 1:
+            container.seek(int(frame_pts[gop_start[i]]), any_frame=False, backward=True, stream=stream)
+            last = gop_start[i] - 1
+        progressed = False
+        for frame in container.decode(stream):
+            if frame.pts is None:
+                ordinal = last + 1
+            else:
+                ordinal = int(np.searchsorted(frame_pts, frame.pts))
+                if ordinal >= len(frame_pts) or frame_pts[ordinal] != frame.pts:
+                    continue
+            progressed = True
+            if ordinal in wanted:
+                frames[ordinal] = frame
+            last = max(last, ordinal)
+            while i < len(targets) and targets[i] <= last:
+                i += 1
+            if i == len(targets) or gop_start[i] > last + 1:
+                break
+        if not progressed:
+            break
+    return frames
+
+
+# decoding threads of a video stream, 0 lets FFmpeg pick (one per core), see `WorkerThreadBudget`
+_DECODE_THREADS = 0
+
+
+def set_decode_threads(num_threads):
+    global _DECODE_THREADS
+    _DECODE_THREADS = num_threads
+
+
+def configure_video_stream(stream):
+    stream.thread_type = "AUTO"
+    if _DECODE_THREADS > 0:
+        stream.codec_context.thread_count = _DECODE_THREADS
+
+
+def frame_to_ndarray(frame, short_side=None):
+    """
+    Convert an av.VideoFrame to an RGB uint8 array (HxWx3), when `short_side` is given the
+    decoder's scaler resizes the frame in the same pass so that its shorter side is `short_side`
+    (frames are never enlarged).
+    """
+    if short_side is None or min(frame.width, frame.height) <= short_side:
+        return frame.to_rgb().to_ndarray()
+    if frame.width < frame.height:
+        width, height = short_side, int(round(frame.height * short_side / frame.width))
+    else:
+        width, height = int(round(frame.width * short_side / frame.height)), short_side
+    return frame.reformat(width=width, height=height, format='rgb24', interpolation='AREA').to_ndarray()
+
+
+def plan_decode_segments(ranges, max_gap):
+    """
+    Merge the pts ranges of all clips into the segments decoded after one seek each,
+    two ranges are decoded in one pass unless the gap between them exceeds `max_gap`.
+
+    Args:
+        ranges (list[tuple]): (start_pts, end_pts) of each clip
+        max_gap (int): the largest gap (in pts) decoded through instead of seeking
+
+    Returns:
+        list[tuple]: sorted, non-overlapping (start_pts, end_pts) segments
+    """
+    segments = []
+    for start_pts, end_pts in sorted(ranges):
+        if len(segments) > 0 and start_pts - segments[-1][1] <= max_gap:
+            segments[-1] = (segments[-1][0], max(segments[-1][1], end_pts))
+        else:
+            segments.append((start_pts, end_pts))
+    return segments
+
+
+def planned_decoding(container, segments, margin=1024):
+    """
+    Decode the segments from `plan_decode_segments` in one forward pass.
+
+    Returns:
+        dict: pts -> av.VideoFrame of the frames inside the segments
+    """
+    stream = container.streams.video[0]
+    frames = {}
+    for video_start_pts, video_end_pts in segments:
+        # Seeking in the stream is imprecise. Thus, seek to an ealier PTS by a margin pts.
+        container.seek(max(video_start_pts - margin, 0), any_frame=False, backward=True, stream=stream)
+        for frame in container.decode(stream):
+            if frame.pts < video_start_pts:
+                continue
+            if frame.pts <= video_end_pts:
+                frames[frame.pts] = frame
+            else:
+                break
+    return frames
+
+
+def count_video_packets(container):
+    """Number of frames of the video stream by demuxing its packets, the container is seeked back to the start."""
+    stream = container.streams.video[0]
+    num_packets = 0
+    for packet in container.demux(stream):
+        # the flushing packet at the end is empty
+        if packet.size > 0:
+            num_packets += 1
+    container.seek(0, any_frame=False, backward=True, stream=stream)
+    return num_packets
+
+
+def streaming_decoding(container, indices, short_side=None):
+    """
+    Decode the video stream from the current position and convert only the frames whose ordinal
+    (in presentation order) is in `indices`, stopping after the last one. Memory is bounded by the clip
+    instead of the video length. Indices past the end of a truncated video get the last decoded frame.
+    """
+    wanted = set(indices.tolist())
+    last_idx = max(wanted)
+    frames = {}
+    last_frame, num_decoded = None, 0
+    for frame in container.decode({'video': 0}):
+        if num_decoded in wanted:
+            frames[num_decoded] = frame_to_ndarray(frame, short_side)
+        last_frame = frame
+        num_decoded += 1
+        if num_decoded > last_idx:
+            break
+    if len(frames) < len(wanted):
+        if last_frame is None:
+            raise ValueError("no frame is decoded")
+        last = frames.get(num_decoded - 1, None)
+        last = frame_to_ndarray(last_frame, short_side) if last is None else last
+        frames = {i: frames.get(i, last) for i in wanted}
+    return np.asarray([frames[i] for i in indices])
+
+
 class VideoDataSetOnline(VideoDataSet):
 
     def __init__(self, root_path, list_file, num_groups=8, frames_per_group=1, sample_offset=0,
                  num_clips=1, modality='rgb', dense_sampling=False, fixed_offset=True,
                  image_tmpl='{:05d}.jpg', transform=None, is_train=True, test_mode=False, seperator=' ',
                  filter_video=0, num_classes=None, whole_video=False,
-                 fps=29.97, audio_length=1.28, resampling_rate=24000, frame_order='normal'):
+                 fps=29.97, audio_length=1.28, resampling_rate=24000, frame_order='normal',
+                 video_index=None, decode_gop_size=32, decode_short_side=None, clip_format='pil', num_views=1,
+                 frame_cache=None, quarantine=None, reader='pyav'):
         """
 
         Arguments have different meaning when dense_sampling is True:
@@ -959,9 +2025,21 @@ class VideoDataSetOnline(VideoDataSet):
             fps (float): frame rate per second, used to localize sound when frame idx is selected.
             audio_length (float): the time window to extract audio feature.
             resampling_rate (int): used to resampling audio extracted from wav
+            frame_order (str): normal, reverse or random order of the returned frames
+            video_index (str): keyframe/PTS sidecar of the list file (see `build_video_index.py`),
+                               indexed videos are decoded only around the sampled frames
+            decode_gop_size (int): when clips are apart less than this number of frames, the frames
+                                   between them are decoded instead of seeking again
+            decode_short_side (int): let the decoder resize the selected frames to this shorter side,
+                                     usually the scale size of the augmentor (see `get_decode_short_side`)
+            clip_format (str): 'pil' returns a list of PIL images, 'array' returns the frames as one
+                               (T x H x W x C) uint8 array for the array backend of `get_augmentor`
+            quarantine (str): quarantine list of the list file (see `scan_dataset.py`)
+            reader (str): 'pyav' for the built-in decoder, otherwise a backend of `video_readers.py`
+                          (the video index and the clip planning only apply to 'pyav')
         """
         self.frame_order = frame_order
-        if not _HAS_PYAV:
+        if reader == 'pyav' and not _HAS_PYAV:
             raise ValueError(_PYAV_ERROR_MSG)
         if modality not in ['rgb', 'rgbdiff']:
             raise ValueError("modality should be 'rgb' or 'rgbdiff'.")
@@ -969,22 +2047,78 @@ class VideoDataSetOnline(VideoDataSet):
         super().__init__(root_path, list_file, num_groups, frames_per_group, sample_offset,
                          num_clips, modality, dense_sampling, fixed_offset,
                          image_tmpl, transform, is_train, test_mode, seperator,
-                         filter_video, num_classes, whole_video, fps, audio_length, resampling_rate)
-
-    def remove_data(self, idx):
-        original_video_num = len(self.video_list)
-        self.video_list = [v for i, v in enumerate(self.video_list) if i not in idx]
-        print("Original videos: {}\t remove {} videos, remaining {} videos".format(original_video_num, len(idx), len(self.video_list)))
+                         filter_video, num_classes, whole_video, fps, audio_length, resampling_rate,
+                         num_views, frame_cache, quarantine=quarantine)
+        self.decode_gop_size = decode_gop_size
+        self.decode_short_side = decode_short_side
+        if clip_format not in ['pil', 'array']:
+            raise ValueError("clip_format should be 'pil' or 'array'.")
+        self.clip_format = clip_format
+        self.reader = get_video_reader(reader, decode_short_side) if reader != 'pyav' else None
+        self.video_index = VideoIndex(video_index) if video_index is not None else None
+        if self.video_index is not None:
+            num_indexed = sum([1 for i in range(len(self.video_list)) if self.video_list.path(i) in self.video_index])
+            print("{} of {} videos are in the video index {}".format(num_indexed, len(self.video_list), video_index))
 
     def get_data(self, record, indices):
-        indices = indices - 1
+        video_frames = None
+        if self.frame_cache is not None and self.modality == 'rgb':
+            cached = [self.frame_cache.get(record.path, i) for i in indices]
+            if all([x is not None for x in cached]):
+                video_frames = np.stack(cached)
+        if video_frames is None:
+            video_frames = self.decode_frames(record, indices)
+            if self.frame_cache is not None and self.modality == 'rgb':
+                for i, frame in zip(indices, video_frames):
+                    self.frame_cache.put(record.path, i, frame)
+
+        if self.frame_order == 'reverse':
+            video_frames = video_frames[::-1]
+        elif self.frame_order == 'random':
+            video_frames = video_frames[np.random.permutation(len(video_frames))]
+
+        if self.clip_format == 'array':
+            return video_frames
+        images = [Image.fromarray(frame) for frame in video_frames]
+        return images
+
+    def decode_frames(self, record, indices):
+        if self.reader is not None:
+            return self.reader.read(os.path.join(self.root_path, record.path), np.asarray(indices) - 1,
+                                    record.num_frames)
         container = av.open(os.path.join(self.root_path, record.path))
-        container.streams.video[0].thread_type = "AUTO"
+        try:
+            return self._decode_container(container, record, indices)
+        finally:
+            # also when the sample is abandoned by `LatencyGuardDataSet`
+            container.close()
+
+    def _decode_container(self, container, record, indices):
+        indices = indices - 1
+        configure_video_stream(container.streams.video[0])
         frames_length = container.streams.video[0].frames
         duration = container.streams.video[0].duration
 
-    
-        if duration is None or frames_length == 0:
+        video_frames = None
+        video_index = self.video_index.get(record.path) if self.video_index is not None else None
+        if video_index is not None:
+            frame_pts, key_idx = video_index
+            if len(frame_pts) != record.num_frames:
+                length_ratio = len(frame_pts) / record.num_frames
+                indices = np.around(indices * length_ratio).astype(int)
+            indices = np.clip(indices, 0, len(frame_pts) - 1)
+            try:
+                frames = indexed_decoding(container, frame_pts, key_idx, indices)
+                if all([i in frames for i in indices]):
+                    video_frames = np.asarray([frame_to_ndarray(frames[i], self.decode_short_side) for i in indices])
+            except Exception as e:
+                print("exception in indexed decoding")
+                print(e)
+            if video_frames is None:
+                # the index is out of date, fall back to decode the whole video
+                indices = np.around(indices * (record.num_frames / len(frame_pts))).astype(int)
+            decode_all = video_frames is None
+        elif duration is None or frames_length == 0:
             # If failed to fetch the decoding information, decode the entire video.
             # video_start_pts, video_end_pts = 0, math.inf
             # print("get true at 1")
@@ -1003,71 +2137,44 @@ class VideoDataSetOnline(VideoDataSet):
             video_end_pts = int(end_idx * timebase)
             decode_all = False
 
-        def _selective_decoding(container, index, timebase):
-            margin = 1024
-            start_idx, end_idx = min(index), max(index)
-            video_start_pts = int(start_idx * timebase)
-            video_end_pts = int(end_idx * timebase)
-            seek_offset = max(video_start_pts - margin, 0)
-            container.seek(seek_offset, any_frame=False, backward=True,
-                           stream=container.streams.video[0])
-            success = True
-            video_frames = None
+        # If video stream was found, fetch video frames from the video.
+        if not decode_all and video_frames is None:
+            timebase = duration / frames_length
+            clip_ranges = []
+            for i in range(self.num_clips):
+                curr_index = indices[i * self.num_frames: (i + 1) * self.num_frames]
+                clip_ranges.append((int(min(curr_index) * timebase), int(max(curr_index) * timebase)))
+            # decode the union of all clips in one forward pass and scatter the frames back
+            segments = plan_decode_segments(clip_ranges, int(self.decode_gop_size * timebase))
             try:
-                frames = {}
-                for frame in container.decode({'video': 0}):
-                    if frame.pts < video_start_pts:
-                        continue
-                    if frame.pts <= video_end_pts:
-                        frames[frame.pts] = frame
-                    else:
-                        break
-                # the decoded frames is a whole region but we might subsample it
-                video_frames = np.asarray([frames[pts].to_rgb().to_ndarray() for pts in sorted(frames)])
-                index = np.linspace(0, max(0, len(video_frames) - 1), num=self.num_frames, dtype=int)
-                if len(video_frames) == 0:  # somehow decoding is wrong
-                    success = False
-                else:
-                    video_frames = video_frames[index, ...]
+                frames = planned_decoding(container, segments)
+                decoded_pts = sorted(frames)
+                video_frames = []
+                for video_start_pts, video_end_pts in clip_ranges:
+                    # the decoded frames is a whole region but we might subsample it
+                    curr_frames = [frames[pts] for pts in decoded_pts
+                                   if video_start_pts <= pts <= video_end_pts]
+                    if len(curr_frames) == 0:  # somehow decoding is wrong
+                        raise ValueError("no frame is decoded in pts [{}, {}]".format(video_start_pts, video_end_pts))
+                    index = np.linspace(0, len(curr_frames) - 1, num=self.num_frames, dtype=int)
+                    video_frames.extend([frame_to_ndarray(curr_frames[i], self.decode_short_side) for i in index])
+                video_frames = np.asarray(video_frames)
             except Exception as e:
                 print("exception in selective decoding")
                 print(e)
-                success = False
-
-            return video_frames, success
-
-        # If video stream was found, fetch video frames from the video.
-        # Seeking in the stream is imprecise. Thus, seek to an ealier PTS by a
-        # margin pts.
-        if not decode_all:
-            timebase = duration / frames_length
-            video_frames = None
-            for i in range(self.num_clips):
-                curr_index = indices[(i) * self.num_frames: (i + 1) * self.num_frames]
-                curr_video_frames, success = _selective_decoding(container, curr_index, timebase)
-                if not success:
-                    # print("get true at 2")
-                    decode_all = True
-                    break
-                if video_frames is not None:
-                    video_frames = np.concatenate((video_frames, curr_video_frames), axis=0)
-                else:
-                    video_frames = curr_video_frames
+                decode_all = True
         if decode_all:
             container.seek(0, any_frame=False, backward=True, stream=container.streams.video[0])
-            frames = {}
-
-            # print("reached here", flush=True)
-            # print(os.path.join(self.root_path, record.path))
-            for frame in container.decode({'video': 0}):
-                frames[frame.pts] = frame
-            video_frames = np.asarray([frames[pts].to_rgb().to_ndarray() for pts in sorted(frames)])
-            total_frames = len(video_frames)
+            # count the frames without decoding, then keep only the sampled ones while decoding
+            total_frames = count_video_packets(container)
+            if total_frames == 0:
+                total_frames = record.num_frames
             if total_frames != record.num_frames:
                 # remap the index
                 length_ratio = total_frames / record.num_frames
                 indices = np.around(indices * length_ratio).astype(int)
-            video_frames = video_frames[indices, ...]
+            indices = np.clip(indices, 0, total_frames - 1)
+            video_frames = streaming_decoding(container, indices, self.decode_short_side)
 
             """
             if self.modality == 'rgbdiff':
@@ -1082,15 +2189,342 @@ class VideoDataSetOnline(VideoDataSet):
                 video_frames = video_diff
             else:
             """
-        images = [Image.fromarray(frame) for frame in video_frames]
         # TODO: support rgb diff, calculate end_pts differently.
-        container.close()
+        return video_frames
+
+
+def default_shard_index_path(list_file):
+    return os.path.splitext(list_file)[0] + '.shards.json'
+
+
+def iterate_shard(shard_path):
+    """
+    Read a tar shard written by `build_shards.py` sequentially, yields (meta, data) per video where
+    meta has path, start_frame, end_frame, label and format ('pack' or the video extension).
+    """
+    meta, key = None, None
+    with tarfile.open(shard_path, mode='r|') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            member_key, ext = member.name.split('.', 1)
+            buf = tar.extractfile(member).read()
+            if ext == 'json':
+                meta, key = json.loads(buf.decode('utf-8')), member_key
+            elif member_key == key:
+                yield meta, buf
+                meta, key = None, None
+
+
+class VideoShardDataSet(data.IterableDataset):
+
+    def __init__(self, shard_index, num_groups=8, frames_per_group=1, sample_offset=0, num_clips=1,
+                 modality='rgb', dense_sampling=False, fixed_offset=True, transform=None, is_train=True,
+                 test_mode=False, filter_video=0, num_classes=None, whole_video=False, num_views=1,
+                 shuffle_buffer=100, seed=0, decode_short_side=None, clip_format='pil'):
+        """
+        Reads the videos of a list file from tar shards written by `build_shards.py` sequentially, for
+        file systems where random access is slow. The shards are split across the distributed ranks
+        and the DataLoader workers, and shuffled per epoch; the videos are shuffled within a buffer.
+        Returns the same samples as `VideoDataSet`, see it for the sampling arguments. Every rank yields
+        `len(self)` samples per pass, the shards of a worker are read again when they run out.
+
+        Args:
+            shard_index (str): the json index of the shards (see `default_shard_index_path`)
+            shuffle_buffer (int): number of encoded videos (as stored in the shards) a video is drawn from
+                                  in training, kept in memory by each worker
+            seed (int): seed of the shard and buffer shuffling, the same on all ranks
+            decode_short_side (int): decode the frames at this shorter side
+            clip_format (str): 'array' returns the frames of shards of videos as one (T x H x W x C)
+                               uint8 array for the array backend of `get_augmentor`, otherwise PIL images
+        """
+        if modality not in ['flow', 'rgb', 'rgbdiff']:
+            raise ValueError("modality should be 'flow' or 'rgb' or 'rgbdiff'.")
+        with open(shard_index) as f:
+            index = json.load(f)
+        shard_dir = os.path.dirname(shard_index)
+        self.shards = [os.path.join(shard_dir, x['name']) for x in index['shards']]
+        self.num_videos = sum([x['num_videos'] for x in index['shards']])
+        self.num_groups = num_groups
+        self.num_frames = num_groups
+        self.frames_per_group = frames_per_group
+        self.sample_freq = frames_per_group
+        self.num_clips = num_clips
+        self.sample_offset = sample_offset
+        self.fixed_offset = fixed_offset
+        self.dense_sampling = dense_sampling
+        self.modality = modality.lower()
+        self.transform = transform
+        self.is_train = is_train
+        self.test_mode = test_mode
+        self.filter_video = filter_video
+        self.whole_video = whole_video
+        self.num_classes = num_classes
+        self.num_views = num_views
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.decode_short_side = decode_short_side
+        self.clip_format = clip_format
+        self.num_consecutive_frames = 5 if self.modality in ['flow', 'rgbdiff'] else 1
+        self.multi_label = index.get('multi_label', False)
+        self.epoch = 0
+        # passes of this copy of the dataset, persistent workers do not see set_epoch
+        self.num_passes = 0
+        if dist.is_available() and dist.is_initialized():
+            self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+        else:
+            self.rank, self.world_size = 0, 1
+        print("The number of videos is {} in {} shards".format(self.num_videos, len(self.shards)), flush=True)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        """
+        Every rank yields this many samples per pass, padded by wrapping around as DistributedSampler.
+        Each DataLoader worker batches its own share, so the loader yields up to one partial batch
+        per worker (none with drop_last) and the number of batches can differ from `len(loader)` by
+        up to the number of workers; it is the same on every rank.
+        """
+        return int(math.ceil(self.num_videos / self.world_size))
+
+    def _shards_of_worker(self, epoch):
+        """Returns the shards of this worker and the number of samples it yields from them."""
+        shards = list(self.shards)
+        if self.is_train:
+            random.Random(self.seed + epoch).shuffle(shards)
+        worker_info = data.get_worker_info()
+        num_workers, worker_id = (1, 0) if worker_info is None else (worker_info.num_workers, worker_info.id)
+        num_consumers = self.world_size * num_workers
+        consumer_id = self.rank * num_workers + worker_id
+        worker_shards = shards[consumer_id::num_consumers]
+        if len(worker_shards) == 0:
+            # fewer shards than workers, read one of the shards of another worker
+            worker_shards = [shards[consumer_id % len(shards)]]
+        # the shards hold different numbers of videos, the same quota on every rank keeps the steps in sync
+        num_samples = len(self) // num_workers + int(worker_id < len(self) % num_workers)
+        return worker_shards, num_samples
+
+    get_label = VideoDataSet.get_label
+
+    def _record(self, meta):
+        if self.test_mode:
+            label = -1
+        else:
+            label = meta['label']
+            if len(label) == 1 and not self.multi_label:
+                label = float(label[0])
+        end_frame = meta['end_frame'] - 1 if self.modality == 'rgbdiff' else meta['end_frame']
+        return VideoRecord(meta['path'], meta['start_frame'], end_frame, label)
+
+    def get_data(self, record, indices, meta, buf):
+        if meta['format'] == 'pack':
+            seg_inds = [min(seg_ind + record.start_frame - 1 + i, record.num_frames)
+                        for seg_ind in indices for i in range(self.num_consecutive_frames)]
+            return load_packed_buffer(buf, seg_inds, self.modality, self.decode_short_side,
+                                      as_array=self.clip_format == 'array')
+        if self.modality != 'rgb':
+            raise ValueError("{} of a video shard is not supported.".format(self.modality))
+        if not _HAS_PYAV:
+            raise ValueError(_PYAV_ERROR_MSG)
+        container = av.open(six.BytesIO(buf))
+        try:
+            configure_video_stream(container.streams.video[0])
+            total_frames = count_video_packets(container)
+            if total_frames == 0:
+                total_frames = record.num_frames
+            indices = np.asarray(indices) - 1
+            if total_frames != record.num_frames:
+                indices = np.around(indices * (total_frames / record.num_frames)).astype(int)
+            video_frames = streaming_decoding(container, np.clip(indices, 0, total_frames - 1),
+                                              self.decode_short_side)
+        finally:
+            container.close()
+        if self.clip_format == 'array':
+            return video_frames
+        return [Image.fromarray(frame) for frame in video_frames]
+
+    def _cycled_records(self, shards):
+        # the encoded videos of the shards, read again from the start when they run out
+        while True:
+            num_records = 0
+            for shard in shards:
+                for meta, buf in iterate_shard(shard):
+                    record = self._record(meta)
+                    if not self.test_mode and record.num_frames < self.filter_video:
+                        continue
+                    num_records += 1
+                    yield shard, meta, buf
+            if num_records == 0:
+                raise ValueError("No video is read from the shards {}.".format(shards))
+
+    def _shuffled(self, records, rng):
+        # the buffer holds encoded videos, they are decoded and augmented once drawn
+        buffer = []
+        for record in records:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(record)
+                continue
+            i = rng.randrange(len(buffer))
+            buffer[i], record = record, buffer[i]
+            yield record
+
+    def __iter__(self):
+        epoch = self.epoch + self.num_passes
+        self.num_passes += 1
+        shards, num_samples = self._shards_of_worker(epoch)
+        if num_samples == 0:
+            return
+        records = self._cycled_records(shards)
+        if self.is_train and self.shuffle_buffer > 1:
+            worker_info = data.get_worker_info()
+            rng = random.Random((self.seed + epoch) * 100003 + self.rank * 1009 +
+                                (worker_info.id if worker_info is not None else 0))
+            records = self._shuffled(records, rng)
+
+        num_yielded, num_failed = 0, 0
+        for shard, meta, buf in records:
+            record = self._record(meta)
+            indices = sample_train_clip(record.num_frames, self.num_consecutive_frames, self.num_frames,
+                                        self.sample_freq, self.dense_sampling, self.num_clips) \
+                if self.is_train else \
+                sample_val_test_clip(record.num_frames, self.num_consecutive_frames, self.num_frames,
+                                     self.sample_freq, self.dense_sampling, self.fixed_offset,
+                                     self.num_clips, self.whole_video)
+            try:
+                images = self.get_data(record, indices, meta, buf)
+            except Exception as e:
+                print("Failed to read {} of {}: {}".format(record.path, shard, e), flush=True)
+                num_failed += 1
+                if num_failed == 1000:
+                    raise ValueError("1000 videos in a row failed to read from the shards {}.".format(shards))
+                continue
+            num_failed = 0
+            images = augment_views(self.transform, images, self.num_views)
+            num_yielded += 1
+            yield images, self.get_label(record)
+            if num_yielded == num_samples:
+                return
+
+
+def default_memmap_path(list_file):
+    return os.path.splitext(list_file)[0] + '.frames'
+
+
+def save_memmap_index(data_file, paths, offsets, num_frames, heights, widths):
+    """
+    Write the index of a frame store next to it (`data_file` + '.npz'), the frames of video i are
+    the (num_frames[i] x heights[i] x widths[i] x 3) uint8 array starting at byte offsets[i] of `data_file`.
+    """
+    with open(data_file + '.npz', 'wb') as f:
+        np.savez(f, paths=np.asarray([p.encode('utf-8') for p in paths], dtype=np.bytes_),
+                 offsets=np.asarray(offsets, dtype=np.int64), num_frames=np.asarray(num_frames, dtype=np.int64),
+                 heights=np.asarray(heights, dtype=np.int64), widths=np.asarray(widths, dtype=np.int64))
+
+
+class VideoMemmap(object):
+    """Pre-decoded uint8 frames of a list file in one memory-mapped file, created by `build_memmap.py`."""
+
+    def __init__(self, data_file):
+        index = np.load(data_file + '.npz')
+        self.data_file = data_file
+        self.paths = {p.decode('utf-8'): i for i, p in enumerate(index['paths'])}
+        self.offsets = index['offsets']
+        self.num_frames = index['num_frames']
+        self.heights = index['heights']
+        self.widths = index['widths']
+        self.data = None
+
+    def __getstate__(self):
+        # the mapping is opened again in each worker instead of pickling the whole file
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, path):
+        return path in self.paths
+
+    def get(self, path):
+        """
+        Returns:
+            np.ndarray: (N x H x W x 3) uint8 view of all frames of the video; None if it is not stored
+        """
+        i = self.paths.get(path, None)
+        if i is None:
+            return None
+        if self.data is None:
+            # copy-on-write, the frames can be modified in place without touching the file
+            self.data = np.memmap(self.data_file, dtype=np.uint8, mode='c')
+        shape = (int(self.num_frames[i]), int(self.heights[i]), int(self.widths[i]), 3)
+        return self.data[self.offsets[i]:self.offsets[i] + np.prod(shape)].reshape(shape)
+
+
+class VideoDataSetMemmap(VideoDataSet):
+
+    def __init__(self, root_path, list_file, num_groups=8, frames_per_group=1, sample_offset=0,
+                 num_clips=1, modality='rgb', dense_sampling=False, fixed_offset=True,
+                 image_tmpl='{:05d}.jpg', transform=None, is_train=True, test_mode=False, seperator=' ',
+                 filter_video=0, num_classes=None, whole_video=False,
+                 fps=29.97, audio_length=1.28, resampling_rate=24000, frame_order='normal',
+                 memmap_file=None, clip_format='pil', num_views=1, frame_cache=None, quarantine=None):
+        """
+        Same arguments as `VideoDataSetOnline`, the frames are read from a frame store instead of decoded.
+
+        Args:
+            memmap_file (str): frame store of the list file (see `build_memmap.py`),
+                               defaults to <list_file without extension>.frames
+            clip_format (str): 'pil' returns a list of PIL images, 'array' returns the frames as one
+                               (T x H x W x C) uint8 array for the array backend of `get_augmentor`
+        """
+        if modality not in ['rgb']:
+            raise ValueError("modality should be 'rgb'.")
+        if clip_format not in ['pil', 'array']:
+            raise ValueError("clip_format should be 'pil' or 'array'.")
+        if frame_cache is not None:
+            # the frame store already holds decoded frames, read through the page cache
+            raise ValueError("VideoDataSetMemmap does not use a frame cache.")
+
+        super().__init__(root_path, list_file, num_groups, frames_per_group, sample_offset,
+                         num_clips, modality, dense_sampling, fixed_offset,
+                         image_tmpl, transform, is_train, test_mode, seperator,
+                         filter_video, num_classes, whole_video, fps, audio_length, resampling_rate,
+                         num_views, quarantine=quarantine)
+        self.frame_order = frame_order
+        self.clip_format = clip_format
+        memmap_file = default_memmap_path(list_file) if memmap_file is None else memmap_file
+        self.memmap = VideoMemmap(memmap_file)
+        original_video_num = len(self.video_list)
+        self.video_list = self.video_list.select(
+            np.asarray([self.video_list.path(i) in self.memmap for i in range(original_video_num)], dtype=bool))
+        print("{} of {} videos are in the frame store {}".format(len(self.video_list), original_video_num, memmap_file))
+
+    def get_data(self, record, indices):
+        video = self.memmap.get(record.path)
+        indices = np.asarray(indices) - 1
+        if len(video) != record.num_frames:
+            # remap the index
+            length_ratio = len(video) / record.num_frames
+            indices = np.around(indices * length_ratio).astype(int)
+        indices = np.clip(indices, 0, len(video) - 1)
+
+        step = indices[1] - indices[0] if len(indices) > 1 else 1
+        if step > 0 and np.all(np.diff(indices) == step):
+            # evenly spaced frames (e.g. a single dense clip) are a strided view of the store
+            video_frames = video[indices[0]:indices[-1] + 1:step]
+        else:
+            video_frames = video[indices]
 
         if self.frame_order == 'reverse':
-            images = images[::-1]
+            video_frames = video_frames[::-1]
         elif self.frame_order == 'random':
-            random.shuffle(images)
+            video_frames = video_frames[np.random.permutation(len(video_frames))]
 
+        if self.clip_format == 'array':
+            return video_frames
+        images = [Image.fromarray(frame) for frame in video_frames]
         return images
 
 
@@ -1203,7 +2637,7 @@ class MultiVideoDataSetOnline(data.Dataset):
                 record = VideoRecord(video_dataset.keys[index].decode("utf-8"), 1, num_frames, unpacked_video[-1])
 
                 images = video_dataset.get_data(record, indices, video_dataset.unpacked_video)
-                video_dataset.unpacked_video = None
+                video_dataset.release_buffer()
 
             images = video_dataset.transform(images)
             label = video_dataset.get_label(record)
@@ -1216,11 +2650,13 @@ class MultiVideoDataSetOnline(data.Dataset):
 
 
 def get_dataloader(loader_type, *args, **kwargs) -> \
-        Union[VideoDataSetLMDB, VideoDataSetOnline, VideoDataSet]:
+        Union[VideoDataSetLMDB, VideoDataSetOnline, VideoDataSetMemmap, VideoDataSet]:
     if loader_type == 'lmdb':
         return VideoDataSetLMDB(*args, **kwargs)
     elif loader_type == 'pyav':
         return VideoDataSetOnline(*args, **kwargs)
+    elif loader_type == 'memmap':
+        return VideoDataSetMemmap(*args, **kwargs)
     elif loader_type == 'jpeg':
         return VideoDataSet(*args, **kwargs)
     else:
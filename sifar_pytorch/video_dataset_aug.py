@@ -1,4 +1,6 @@
 import multiprocessing
+import os
+from itertools import islice
 from typing import Union, List, Tuple
 
 import torch
@@ -9,17 +11,43 @@ import torch.utils.data.distributed
 import torchvision.transforms as transforms
 from .video_transforms import (GroupRandomHorizontalFlip, GroupOverSample,
                                GroupMultiScaleCrop, GroupScale, GroupCenterCrop, GroupRandomCrop,
-                               GroupNormalize, Stack, ToTorchFormatTensor, GroupRandomScale)
+                               GroupNormalize, Stack, ToTorchFormatTensor, GroupRandomScale,
+                               ClipRandomHorizontalFlip, ClipOverSample, ClipMultiScaleCrop, ClipScale,
+                               ClipCenterCrop, ClipRandomCrop, ClipRandomScale, ClipColorJitter,
+                               ClipToTorchFormatTensor)
+from .samplers import RASampler
+from .video_dataset import PrecollatedBatch, set_decode_threads
+
+try:
+    import cv2
+    _HAS_OPENCV = True
+except ImportError:
+    _HAS_OPENCV = False
 
 def get_augmentor(is_train: bool, image_size: int, mean: List[float] = None,
                   std: List[float] = None, disable_scaleup: bool = False,
                   threed_data: bool = False, version: str = 'v1', scale_range: [int] = None,
-                  modality: str = 'rgb', num_clips: int = 1, num_crops: int = 1, dataset: str = '', no_flip: bool = False):
+                  modality: str = 'rgb', num_clips: int = 1, num_crops: int = 1, dataset: str = '', no_flip: bool = False,
+                  backend: str = 'pil', uint8_output: bool = False):
+    """
+    backend: 'pil' transforms a list of PIL images frame by frame, 'array' transforms the whole clip
+             as one (T x H x W x C) uint8 array with the same random sampling (rgb only).
+    uint8_output: return the uint8 tensor without float conversion and normalization, they are done
+                  per batch in the training process by `utils.BatchNormalize` (rgb only).
+    """
 
     mean = [0.485, 0.456, 0.406] if mean is None else mean
     std = [0.229, 0.224, 0.225] if std is None else std
     scale_range = [256, 320] if scale_range is None else scale_range
 
+    if backend == 'array':
+        if modality not in ['rgb', 'rgbdiff']:
+            raise ValueError("the array backend supports rgb and rgbdiff only.")
+        return _get_clip_augmentor(is_train, image_size, mean, std, disable_scaleup, threed_data,
+                                   version, scale_range, num_clips, num_crops, no_flip, uint8_output)
+    elif backend != 'pil':
+        raise ValueError(f'Unknown augmentor backend: {backend}')
+
     if modality == 'sound':
         augments = [
             Stack(threed_data=threed_data),
@@ -57,25 +85,305 @@ def get_augmentor(is_train: bool, image_size: int, mean: List[float] = None,
                 ]
         augments += [
             Stack(threed_data=threed_data),
-            ToTorchFormatTensor(num_clips_crops=num_clips * num_crops),
-            GroupNormalize(mean=mean, std=std, threed_data=threed_data)
+            ToTorchFormatTensor(num_clips_crops=num_clips * num_crops, to_float=not uint8_output)
         ]
+        if not uint8_output:
+            augments += [GroupNormalize(mean=mean, std=std, threed_data=threed_data)]
 
     augmentor = transforms.Compose(augments)
     return augmentor
 
 
-def build_dataflow(dataset, is_train, batch_size, workers=36, is_distributed=False, drop_last=False):
+def _get_clip_augmentor(is_train, image_size, mean, std, disable_scaleup, threed_data,
+                        version, scale_range, num_clips, num_crops, no_flip, uint8_output):
+    augments = []
+    if is_train:
+        if version == 'v1':
+            augments += [
+                ClipMultiScaleCrop(image_size, [1, .875, .75, .66])
+            ]
+        elif version == 'v2':
+            augments += [
+                ClipRandomScale(scale_range),
+                ClipRandomCrop(image_size),
+                ClipColorJitter(brightness=.5, hue=.3)
+            ]
+        if not no_flip:
+            print("ClipRandomHorizontalFlip Enabled")
+            augments += [ClipRandomHorizontalFlip()]
+    else:
+        scaled_size = image_size if disable_scaleup else int(image_size / 0.875 + 0.5)
+        if num_crops == 1:
+            augments += [
+                ClipScale(scaled_size),
+                ClipCenterCrop(image_size)
+            ]
+        else:
+            flip = True if num_crops == 10 else False
+            augments += [
+                ClipOverSample(image_size, scaled_size, num_crops=num_crops, flip=flip),
+            ]
+    augments += [
+        ClipToTorchFormatTensor(num_clips_crops=num_clips * num_crops, threed_data=threed_data,
+                                to_float=not uint8_output)
+    ]
+    if not uint8_output:
+        augments += [GroupNormalize(mean=mean, std=std, threed_data=threed_data)]
+    return transforms.Compose(augments)
+
+
+def get_decode_short_side(is_train: bool, image_size: int, disable_scaleup: bool = False,
+                          version: str = 'v1', scale_range: [int] = None):
+    """
+    The shorter side the augmentor of `get_augmentor` scales the frames to, so the frames can
+    be decoded at that size directly.
+    """
+    scale_range = [256, 320] if scale_range is None else scale_range
+    if is_train:
+        return max(scale_range) if version == 'v2' else int(image_size / 0.875 + 0.5)
+    return image_size if disable_scaleup else int(image_size / 0.875 + 0.5)
+
+
+def multi_view_collate(batch):
+    """Flattens the (B x K x ...) views of a multi-view dataset to a batch of B * K samples,
+    the K views of a video are next to each other as with RASampler."""
+    images, labels = torch.utils.data.dataloader.default_collate(batch)
+    num_views = images.shape[1]
+    images = images.flatten(0, 1)
+    labels = labels.repeat_interleave(num_views, dim=0)
+    return images, labels
+
+
+def batch_collate(batch):
+    """Passes through a batch already built by the `__getitems__` of the dataset."""
+    if isinstance(batch, PrecollatedBatch):
+        return tuple(batch)
+    return torch.utils.data.dataloader.default_collate(batch)
+
+
+class WorkerThreadBudget(object):
+    """
+    worker_init_fn splitting the cores among the DataLoader workers, each worker gets `num_threads`
+    threads (default: its share of the cores) for torch, OpenCV and the PyAV decoder instead of one
+    thread per core for each of them. With `pin_cpus`, each worker is pinned to its own cores.
+    Under torchrun, the cores are first split among the local ranks unless the launcher already did.
+
+    When several loaders run at the same time (e.g. the labeled, unlabeled and validation loaders
+    with persistent workers), `total_workers` is the number of workers of all of them and
+    `worker_offset` the position of this loader's first worker, so the loaders share the cores.
+    """
+
+    def __init__(self, num_threads=None, pin_cpus=False, report=False, total_workers=None, worker_offset=0):
+        self.num_threads = num_threads
+        self.pin_cpus = pin_cpus
+        self.report = report
+        self.total_workers = total_workers
+        self.worker_offset = worker_offset
+
+    @staticmethod
+    def _os_threads():
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('Threads:'):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return -1
+
+    def __call__(self, worker_id):
+        num_workers = self.total_workers or torch.utils.data.get_worker_info().num_workers
+        worker_id = self.worker_offset + worker_id
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') \
+            else list(range(multiprocessing.cpu_count()))
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+        if local_world_size > 1 and len(cpus) == multiprocessing.cpu_count():
+            cpus_per_rank = max(1, len(cpus) // local_world_size)
+            start = (int(os.environ.get('LOCAL_RANK', 0)) * cpus_per_rank) % len(cpus)
+            cpus = cpus[start:start + cpus_per_rank]
+        cpus_per_worker = max(1, len(cpus) // num_workers)
+        num_threads = self.num_threads if self.num_threads else cpus_per_worker
+        if self.pin_cpus and hasattr(os, 'sched_setaffinity'):
+            start = (worker_id * cpus_per_worker) % len(cpus)
+            cpus = cpus[start:start + cpus_per_worker]
+            os.sched_setaffinity(0, cpus)
+
+        torch.set_num_threads(num_threads)
+        if _HAS_OPENCV:
+            cv2.setNumThreads(num_threads)
+        set_decode_threads(num_threads)
+        if self.report:
+            print("worker {}: torch {} threads, opencv {}, decoder {}, {} OS threads, cpus {}".format(
+                worker_id, torch.get_num_threads(), cv2.getNumThreads() if _HAS_OPENCV else '-',
+                num_threads, self._os_threads(), cpus if self.pin_cpus else len(cpus)), flush=True)
+
+
+def build_dataflow(dataset, is_train, batch_size, workers=36, is_distributed=False, drop_last=False,
+                   persistent_workers=False, repeated_aug=False, num_views=1, batched_getitems=False,
+                   worker_init_fn=None):
+    """
+    repeated_aug: sample with RASampler, every video is seen 3 times (or num_views times) per epoch.
+    num_views: the dataset returns this many views of each video (see `VideoDataSet`), they are
+               flattened into the batch, so batch_size // num_views videos are loaded per batch.
+    batched_getitems: let the dataset load a whole batch at a time with `__getitems__`.
+    worker_init_fn: e.g. `WorkerThreadBudget`.
+    An IterableDataset (e.g. `VideoShardDataSet`) shuffles and splits its data across ranks itself.
+    """
     workers = min(workers, multiprocessing.cpu_count())
     print("workers", workers, multiprocessing.cpu_count())
     shuffle = False
 
-    sampler = torch.utils.data.distributed.DistributedSampler(dataset) if is_distributed else None
-    if is_train:
+    if isinstance(dataset, torch.utils.data.IterableDataset):
+        if repeated_aug:
+            raise ValueError("repeated_aug is not supported by an IterableDataset.")
+        sampler = None
+    elif repeated_aug:
+        num_replicas, rank = (None, None) if is_distributed else (1, 0)
+        sampler = RASampler(dataset, num_replicas, rank, shuffle=is_train,
+                            num_repeats=3 if num_views == 1 else num_views, decode_once=num_views > 1)
+    else:
+        sampler = torch.utils.data.distributed.DistributedSampler(dataset) if is_distributed else None
+    if is_train and not isinstance(dataset, torch.utils.data.IterableDataset):
         shuffle = sampler is None
 
+    collate_fn = None
+    if num_views > 1:
+        batch_size = max(1, batch_size // num_views)
+        collate_fn = multi_view_collate
+    elif batched_getitems and hasattr(dataset, 'batched_getitems'):
+        dataset.batched_getitems = True
+        collate_fn = batch_collate
+
     data_loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle,
-                                              num_workers=workers, pin_memory=True, sampler=sampler, drop_last=drop_last)
+                                              num_workers=workers, pin_memory=True, sampler=sampler, drop_last=drop_last,
+                                              persistent_workers=persistent_workers and workers > 0,
+                                              collate_fn=collate_fn, worker_init_fn=worker_init_fn)
 
     return data_loader
 
+
+class InfiniteLoader(object):
+    """
+    Iterates a DataLoader endlessly, every pass re-shuffles and re-augments the data.
+    Unlike itertools.cycle, no batch is kept after it is consumed.
+    """
+
+    def __init__(self, data_loader):
+        self.data_loader = data_loader
+        self.num_passes = 0
+        self.epoch = None
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        while True:
+            sampler = getattr(self.data_loader, 'sampler', None)
+            if hasattr(sampler, 'set_epoch'):
+                # distributed samplers only re-shuffle for a new epoch number, the later passes of
+                # epoch e use e * 1000 + pass so they do not repeat the order of the next epochs
+                if self.epoch is None:
+                    self.epoch = sampler.epoch
+                if self.num_passes > 0:
+                    sampler.set_epoch(self.epoch * 1000 + self.num_passes)
+            self.num_passes += 1
+            num_batches = 0
+            for batch in self.data_loader:
+                num_batches += 1
+                yield batch
+            if num_batches == 0:
+                raise ValueError("The loader yields no batch to repeat, the dataset has fewer samples "
+                                 "than a batch (with drop_last) or than the sampler keeps.")
+
+
+class JointDataset(torch.utils.data.Dataset):
+    """The labeled and the unlabeled dataset behind one loader, indexed by (0, i) or (1, i)."""
+
+    def __init__(self, labeled_dataset, unlabeled_dataset):
+        self.datasets = [labeled_dataset, unlabeled_dataset]
+
+    def __len__(self):
+        return len(self.datasets[0])
+
+    def __getitem__(self, index):
+        which, i = index
+        return which, self.datasets[which][i]
+
+
+class JointBatchSampler(torch.utils.data.Sampler):
+    """
+    Batches of `batch_size` labeled and `batch_size * mu` unlabeled indices for a JointDataset.
+    Before `sup_thresh` only labeled indices are drawn; afterwards the `cycle_loader` side is
+    re-shuffled and repeated until the other side ends, as `InfiniteLoader` does for two loaders.
+    """
+
+    def __init__(self, num_labeled, num_unlabeled, batch_size, mu=1, drop_last=False, sup_thresh=0,
+                 cycle_loader='labeled'):
+        if cycle_loader not in ['labeled', 'unlabeled']:
+            raise ValueError("cycle_loader should be 'labeled' or 'unlabeled'.")
+        self.num_labeled = num_labeled
+        self.num_unlabeled = num_unlabeled
+        self.batch_size = batch_size
+        self.mu = mu
+        self.drop_last = drop_last
+        self.sup_thresh = sup_thresh
+        self.cycle_loader = cycle_loader
+        self.use_unlabeled = sup_thresh <= 0
+
+    def set_epoch(self, epoch):
+        self.use_unlabeled = epoch >= self.sup_thresh
+
+    def _num_batches(self, num_samples, batch_size):
+        return num_samples // batch_size if self.drop_last else (num_samples + batch_size - 1) // batch_size
+
+    def __len__(self):
+        num_labeled_batches = self._num_batches(self.num_labeled, self.batch_size)
+        if not self.use_unlabeled or self.cycle_loader == 'unlabeled':
+            return num_labeled_batches
+        return self._num_batches(self.num_unlabeled, self.batch_size * self.mu)
+
+    @staticmethod
+    def _indices(num_samples, infinite):
+        while True:
+            for i in torch.randperm(num_samples).tolist():
+                yield i
+            if not infinite:
+                return
+
+    def __iter__(self):
+        labeled = self._indices(self.num_labeled, self.use_unlabeled and self.cycle_loader == 'labeled')
+        unlabeled = self._indices(self.num_unlabeled, self.cycle_loader == 'unlabeled') \
+            if self.use_unlabeled else None
+        for _ in range(len(self)):
+            batch = [(0, i) for i in islice(labeled, self.batch_size)]
+            if unlabeled is not None:
+                batch += [(1, i) for i in islice(unlabeled, self.batch_size * self.mu)]
+            yield batch
+
+
+def joint_collate(batch):
+    """Returns the labeled batch, followed by the unlabeled batch if there is one."""
+    labeled = [x for which, x in batch if which == 0]
+    unlabeled = [x for which, x in batch if which == 1]
+    labeled = torch.utils.data.dataloader.default_collate(labeled)
+    if len(unlabeled) == 0:
+        return labeled
+    return labeled, torch.utils.data.dataloader.default_collate(unlabeled)
+
+
+def build_joint_dataflow(labeled_dataset, unlabeled_dataset, batch_size, mu, workers=36, drop_last=False,
+                         sup_thresh=0, cycle_loader='labeled', worker_init_fn=None):
+    """
+    One loader (one worker pool and prefetch queue) for both train sets, it yields
+    (samples, targets) before `sup_thresh` and ((samples, targets), (samples_u, targets_u)) after,
+    call `loader.batch_sampler.set_epoch(epoch)` at the start of every epoch.
+    """
+    workers = min(workers, multiprocessing.cpu_count())
+    print("workers", workers, multiprocessing.cpu_count())
+    batch_sampler = JointBatchSampler(len(labeled_dataset), len(unlabeled_dataset), batch_size, mu,
+                                      drop_last, sup_thresh, cycle_loader)
+    data_loader = torch.utils.data.DataLoader(JointDataset(labeled_dataset, unlabeled_dataset),
+                                              batch_sampler=batch_sampler, num_workers=workers,
+                                              pin_memory=True, collate_fn=joint_collate,
+                                              persistent_workers=workers > 0, worker_init_fn=worker_init_fn)
+    return data_loader
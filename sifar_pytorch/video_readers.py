@@ -0,0 +1,170 @@
+"""
+Video reader backends of `VideoDataSetOnline` besides its built-in PyAV decoder ('pyav').
+
+A reader returns the frames at the sampled indices of one video as a (T x H x W x 3) uint8 RGB array,
+the indices count the frames of the list file and are remapped when the reader finds a different
+number of frames. `benchmark_readers.py` compares the backends on a list file.
+"""
+import numpy as np
+from PIL import Image
+
+try:
+    import torchvision.io
+    _HAS_TORCHVISION_IO = True
+except ImportError as e:
+    _HAS_TORCHVISION_IO = False
+    _TORCHVISION_IO_ERROR_MSG = e
+
+try:
+    import cv2
+    _HAS_OPENCV = True
+except ImportError as e:
+    _HAS_OPENCV = False
+    _OPENCV_ERROR_MSG = e
+
+try:
+    import decord
+    _HAS_DECORD = True
+except ImportError as e:
+    _HAS_DECORD = False
+    _DECORD_ERROR_MSG = e
+
+
+def remap_indices(indices, num_frames, total_frames):
+    """Map 0-based `indices` of a video listed with `num_frames` frames onto its `total_frames` decodable frames."""
+    indices = np.asarray(indices)
+    if total_frames != num_frames:
+        indices = np.around(indices * (total_frames / num_frames)).astype(int)
+    return np.clip(indices, 0, total_frames - 1)
+
+
+def resize_short_side(frame, short_side=None):
+    """Resize an HxWx3 uint8 frame so that its shorter side is `short_side`, frames are never enlarged."""
+    height, width = frame.shape[:2]
+    if short_side is None or min(width, height) <= short_side:
+        return frame
+    if width < height:
+        size = (short_side, int(round(height * short_side / width)))
+    else:
+        size = (int(round(width * short_side / height)), short_side)
+    return np.asarray(Image.fromarray(frame).resize(size, Image.BILINEAR))
+
+
+class VideoReader(object):
+    """Base class of the readers, `short_side` resizes the frames as `decode_short_side` of the datasets."""
+
+    def __init__(self, short_side=None):
+        self.short_side = short_side
+
+    def read(self, video_path, indices, num_frames):
+        """
+        Args:
+            video_path (str): the video file
+            indices (numpy.ndarray): 0-based indices of the frames, in the order they are returned
+            num_frames (int): number of frames of the video in the list file
+
+        Returns:
+            numpy.ndarray: (T x H x W x 3) uint8 RGB frames
+        """
+        raise NotImplementedError
+
+
+class TorchvisionReader(VideoReader):
+    """torchvision.io, reads the PTS of the video and decodes the range of the sampled frames."""
+
+    def __init__(self, short_side=None):
+        if not _HAS_TORCHVISION_IO:
+            raise ValueError(_TORCHVISION_IO_ERROR_MSG)
+        super().__init__(short_side)
+
+    def read(self, video_path, indices, num_frames):
+        frame_pts, _ = torchvision.io.read_video_timestamps(video_path, pts_unit='pts')
+        indices = remap_indices(indices, num_frames, len(frame_pts))
+        start_idx, end_idx = int(indices.min()), int(indices.max())
+        video, _, _ = torchvision.io.read_video(video_path, start_pts=frame_pts[start_idx],
+                                                end_pts=frame_pts[end_idx], pts_unit='pts', output_format='THWC')
+        video = video.numpy()
+        # the decoded range starts at start_idx, truncated ranges repeat their last frame
+        offsets = np.minimum(indices - start_idx, len(video) - 1)
+        return np.asarray([resize_short_side(video[i], self.short_side) for i in offsets])
+
+
+class OpenCVReader(VideoReader):
+    """OpenCV, seeks by frame number and only grabs the frames between close indices."""
+
+    def __init__(self, short_side=None, max_grab=16):
+        if not _HAS_OPENCV:
+            raise ValueError(_OPENCV_ERROR_MSG)
+        super().__init__(short_side)
+        self.max_grab = max_grab
+
+    def _resize(self, frame):
+        height, width = frame.shape[:2]
+        if self.short_side is None or min(width, height) <= self.short_side:
+            return frame
+        if width < height:
+            size = (self.short_side, int(round(height * self.short_side / width)))
+        else:
+            size = (int(round(width * self.short_side / height)), self.short_side)
+        return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+    def read(self, video_path, indices, num_frames):
+        cap = cv2.VideoCapture(video_path)
+        try:
+            total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            if total_frames <= 0:
+                total_frames = num_frames
+            indices = remap_indices(indices, num_frames, total_frames)
+            frames = {}
+            position = 0
+            last = None
+            for idx in sorted(set(indices.tolist())):
+                if idx < position or idx - position > self.max_grab:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
+                    position = idx
+                while position < idx and cap.grab():
+                    position += 1
+                ok, frame = cap.read()
+                if ok:
+                    position += 1
+                    last = self._resize(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+                elif last is None:
+                    raise ValueError("failed to read frame {} of {}".format(idx, video_path))
+                frames[idx] = last
+        finally:
+            cap.release()
+        return np.asarray([frames[i] for i in indices])
+
+
+class DecordReader(VideoReader):
+    """decord, reads the sampled frames with one batched call."""
+
+    def __init__(self, short_side=None):
+        if not _HAS_DECORD:
+            raise ValueError(_DECORD_ERROR_MSG)
+        super().__init__(short_side)
+
+    def read(self, video_path, indices, num_frames):
+        vr = decord.VideoReader(video_path, ctx=decord.cpu(0), num_threads=1)
+        indices = remap_indices(indices, num_frames, len(vr))
+        video = vr.get_batch(indices.tolist()).asnumpy()
+        return np.asarray([resize_short_side(frame, self.short_side) for frame in video])
+
+
+VIDEO_READERS = {
+    'torchvision': TorchvisionReader,
+    'opencv': OpenCVReader,
+    'decord': DecordReader,
+}
+
+
+def available_readers():
+    """Names of the readers whose library is installed, 'pyav' is the built-in decoder of `VideoDataSetOnline`."""
+    installed = {'torchvision': _HAS_TORCHVISION_IO, 'opencv': _HAS_OPENCV, 'decord': _HAS_DECORD}
+    return ['pyav'] + [name for name in VIDEO_READERS if installed[name]]
+
+
+def get_video_reader(name, short_side=None):
+    if name not in VIDEO_READERS:
+        raise ValueError("Unknown video reader {}, choose from {}.".format(name, ['pyav'] + list(VIDEO_READERS)))
+    return VIDEO_READERS[name](short_side)
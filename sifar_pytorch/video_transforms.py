@@ -141,6 +141,30 @@ class GroupOverSample(object):
 
         image_w, image_h = img_group[0].size
         crop_w, crop_h = self.crop_size
+        offsets = self._crop_offsets(image_w, image_h)
+
+        oversample_group = list()
+        for o_w, o_h in offsets:
+            normal_group = list()
+            flip_group = list()
+            for i, img in enumerate(img_group):
+                crop = img.crop((o_w, o_h, o_w + crop_w, o_h + crop_h))
+                normal_group.append(crop)
+                if self.flip:
+                    flip_crop = crop.copy().transpose(Image.FLIP_LEFT_RIGHT)
+
+                    if img.mode == 'L' and i % 2 == 0:
+                        flip_group.append(ImageOps.invert(flip_crop))
+                    else:
+                        flip_group.append(flip_crop)
+
+            oversample_group.extend(normal_group)
+            if self.flip:
+                oversample_group.extend(flip_group)
+        return oversample_group
+
+    def _crop_offsets(self, image_w, image_h):
+        crop_w, crop_h = self.crop_size
 
         if self.num_crops == 3:
             w_step = (image_w - crop_w) // 4
@@ -162,26 +186,7 @@ class GroupOverSample(object):
 
         else:
             offsets = GroupMultiScaleCrop.fill_fix_offset(False, image_w, image_h, crop_w, crop_h)
-
-        oversample_group = list()
-        for o_w, o_h in offsets:
-            normal_group = list()
-            flip_group = list()
-            for i, img in enumerate(img_group):
-                crop = img.crop((o_w, o_h, o_w + crop_w, o_h + crop_h))
-                normal_group.append(crop)
-                if self.flip:
-                    flip_crop = crop.copy().transpose(Image.FLIP_LEFT_RIGHT)
-
-                    if img.mode == 'L' and i % 2 == 0:
-                        flip_group.append(ImageOps.invert(flip_crop))
-                    else:
-                        flip_group.append(flip_crop)
-
-            oversample_group.extend(normal_group)
-            if self.flip:
-                oversample_group.extend(flip_group)
-        return oversample_group
+        return offsets
 
 
 class GroupMultiScaleCrop(object):
@@ -326,10 +331,12 @@ class Stack(object):
 
 class ToTorchFormatTensor(object):
     """ Converts a PIL.Image (RGB) or numpy.ndarray (H x W x C) in the range [0, 255]
-    to a torch.FloatTensor of shape (C x H x W) in the range [0.0, 1.0] """
-    def __init__(self, div=True, num_clips_crops=1):
+    to a torch.FloatTensor of shape (C x H x W) in the range [0.0, 1.0]
+    (or keeps the uint8 values when to_float is False) """
+    def __init__(self, div=True, num_clips_crops=1, to_float=True):
         self.div = div
         self.num_clips_crops = num_clips_crops
+        self.to_float = to_float
 
     def __call__(self, pic):
         if isinstance(pic, np.ndarray):
@@ -346,6 +353,161 @@ class ToTorchFormatTensor(object):
             # put it from HWC to CHW format
             # yikes, this transpose takes 80% of the loading time/CPU
             img = img.transpose(0, 1).transpose(0, 2).contiguous()
+        if not self.to_float:
+            return img
+        return img.float().div(255) if self.div else img.float()
+
+
+# Transforms below work on a whole clip at once, a uint8 numpy array of (T x H x W x C)
+# (a list of PIL images is stacked first), and apply one crop/resize/flip to all frames in one
+# vectorized call. The random parameters are sampled exactly as their Group* counterparts.
+
+
+def _as_clip(clip):
+    if isinstance(clip, np.ndarray):
+        return clip
+    if isinstance(clip, torch.Tensor):
+        return clip.numpy()
+    return np.stack([np.asarray(img) for img in clip], axis=0)
+
+
+def _resize_clip(clip, width, height):
+    """ Bilinear resize (with antialiasing as PIL) of all frames of a clip together. """
+    if clip.shape[1] == height and clip.shape[2] == width:
+        return clip
+    x = torch.from_numpy(np.ascontiguousarray(clip)).permute(0, 3, 1, 2).float()
+    x = torch.nn.functional.interpolate(x, size=(height, width), mode='bilinear',
+                                        align_corners=False, antialias=True)
+    return x.round_().clamp_(0, 255).to(torch.uint8).permute(0, 2, 3, 1).numpy()
+
+
+def _scaled_size(image_w, image_h, size):
+    # the same output size as torchvision.transforms.Resize with an int size
+    if image_w <= image_h:
+        return size, int(size * image_h / image_w)
+    return int(size * image_w / image_h), size
+
+
+class ClipRandomCrop(GroupRandomCrop):
+
+    def __call__(self, clip):
+        clip = _as_clip(clip)
+        h, w = clip.shape[1:3]
+        th, tw = self.size
+
+        x1 = random.randint(0, w - tw)
+        y1 = random.randint(0, h - th)
+        return clip[:, y1:y1 + th, x1:x1 + tw]
+
+
+class ClipCenterCrop(object):
+    def __init__(self, size):
+        self.size = (int(size), int(size)) if isinstance(size, numbers.Number) else size
+
+    def __call__(self, clip):
+        clip = _as_clip(clip)
+        h, w = clip.shape[1:3]
+        th, tw = self.size
+        y1 = int(round((h - th) / 2.0))
+        x1 = int(round((w - tw) / 2.0))
+        return clip[:, y1:y1 + th, x1:x1 + tw]
+
+
+class ClipRandomHorizontalFlip(object):
+    """Randomly horizontally flips the given clip with a probability of 0.5
+    """
+
+    def __call__(self, clip):
+        clip = _as_clip(clip)
+        v = random.random()
+        if v < 0.5:
+            return clip[:, :, ::-1]
+        return clip
+
+
+class ClipScale(object):
+    """ Rescales the clip so that its smaller edge is 'size'. """
+
+    def __init__(self, size):
+        self.size = size
+
+    def __call__(self, clip):
+        clip = _as_clip(clip)
+        w, h = _scaled_size(clip.shape[2], clip.shape[1], self.size)
+        return _resize_clip(clip, w, h)
+
+
+class ClipRandomScale(GroupRandomScale):
+
+    def __call__(self, clip):
+        selected_size = np.random.randint(low=self.size[0], high=self.size[1] + 1, dtype=int)
+        return ClipScale(selected_size)(clip)
+
+
+class ClipColorJitter(object):
+    """ torchvision ColorJitter with one set of factors for the whole clip. """
+
+    def __init__(self, **kwargs):
+        self.worker = torchvision.transforms.ColorJitter(**kwargs)
+
+    def __call__(self, clip):
+        clip = _as_clip(clip)
+        x = torch.from_numpy(np.ascontiguousarray(clip)).permute(0, 3, 1, 2)
+        return self.worker(x).permute(0, 2, 3, 1).numpy()
+
+
+class ClipOverSample(GroupOverSample):
+    def __init__(self, crop_size, scale_size=None, num_crops=5, flip=False):
+        super().__init__(crop_size, None, num_crops, flip)
+        self.scale_worker = ClipScale(scale_size) if scale_size is not None else None
+
+    def __call__(self, clip):
+        clip = _as_clip(clip)
+        if self.scale_worker is not None:
+            clip = self.scale_worker(clip)
+
+        image_h, image_w = clip.shape[1:3]
+        crop_w, crop_h = self.crop_size
+        oversample_group = list()
+        for o_w, o_h in self._crop_offsets(image_w, image_h):
+            crop = clip[:, o_h:o_h + crop_h, o_w:o_w + crop_w]
+            oversample_group.append(crop)
+            if self.flip:
+                oversample_group.append(crop[:, :, ::-1])
+        return np.concatenate(oversample_group, axis=0)
+
+
+class ClipMultiScaleCrop(GroupMultiScaleCrop):
+
+    def __call__(self, clip):
+        clip = _as_clip(clip)
+        im_size = (clip.shape[2], clip.shape[1])
+
+        crop_w, crop_h, offset_w, offset_h = self._sample_crop_size(im_size)
+        clip = clip[:, offset_h:offset_h + crop_h, offset_w:offset_w + crop_w]
+        return _resize_clip(clip, self.input_size[0], self.input_size[1])
+
+
+class ClipToTorchFormatTensor(object):
+    """ Converts a clip (T x H x W x C) in the range [0, 255] to a torch.FloatTensor of shape
+    ((T x C) x H x W), or (C x T x H x W) for 3D data, in the range [0.0, 1.0]
+    (or keeps the uint8 values when to_float is False) """
+    def __init__(self, div=True, num_clips_crops=1, threed_data=False, to_float=True):
+        self.div = div
+        self.num_clips_crops = num_clips_crops
+        self.threed_data = threed_data
+        self.to_float = to_float
+
+    def __call__(self, clip):
+        clip = _as_clip(clip)
+        img = torch.from_numpy(np.ascontiguousarray(clip))
+        if self.threed_data:
+            img = img.permute(3, 0, 1, 2).contiguous()
+        else:
+            t, h, w, c = img.shape
+            img = img.permute(0, 3, 1, 2).reshape(t * c, h, w)
+        if not self.to_float:
+            return img
         return img.float().div(255) if self.div else img.float()
 
 